@@ -1,16 +1,26 @@
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from models import orm
+from models import orm, display_counter_buffer
 from views import service_blueprint
+from cli import notifications
+from response_cache import response_cache
+from pool_metrics import pool_metrics
+from request_metrics import request_metrics
 
 
 def create_app(config_filename):
     app = Flask(__name__)
     app.config.from_object(config_filename)
     orm.init_app(app)
+    pool_metrics.init_app(app, orm.get_engine(app))
+    request_metrics.init_app(app, orm.get_engine(app))
+    response_cache.init_app(app)
     app.register_blueprint(service_blueprint, url_prefix='/service')
     migrate = Migrate(app, orm)
+    app.cli.add_command(notifications)
+    if app.config['DISPLAY_COUNTER_BUFFER_ENABLED']:
+        display_counter_buffer.start(app)
     return app
 
 
@@ -0,0 +1,419 @@
+"""
+ASGI deployment mode for the notifications service.
+
+The GET requests for the notifications, notification categories and users
+(page mode without other query arguments) run natively on the event loop
+with an asyncpg connection pool. All the other requests, including the ones
+that fail the authentication or don't find the resource, are delegated to
+the WSGI application in a thread pool, so the URL surface and the responses
+are the same as the WSGI build.
+
+Run it with an ASGI server, such as gunicorn with the uvicorn workers:
+    gunicorn --workers 4 --worker-class uvicorn.workers.UvicornWorker asgi:app
+"""
+import asyncio
+import base64
+import io
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+from flask import url_for
+from itsdangerous import BadSignature, SignatureExpired
+from passlib.apps import custom_app_context as password_context
+from werkzeug.http import parse_etags
+from app import create_app, app as flask_app
+from helpers import encode_json, get_etag, verified_credentials_cache
+from http_status import HttpStatus
+from models import NotificationCategorySummary
+from views import user_serializer, notification_serializer, notification_category_serializer
+from views import get_token_serializer
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+NOTIFICATION_COLUMNS = \
+    'n.id, n.message, n.ttl, n.creation_date, n.displayed_times, n.displayed_once, n.version'
+# Maximum number of delegated response chunks waiting to be sent, so a streamed
+# response (such as the NDJSON lists) is never held in memory as a whole
+WSGI_RESPONSE_QUEUE_SIZE = 8
+# Same expression as get_expiration_date_expression, so PostgreSQL can use the index
+UNEXPIRED_CONDITION = "n.creation_date + n.ttl * INTERVAL '1 second' > localtimestamp"
+
+
+class AsyncNotificationService():
+    def __init__(self, flask_app):
+        if asyncpg is None:
+            raise RuntimeError('The asyncpg package is required to use the ASGI deployment mode')
+        self.flask_app = flask_app
+        self.pool = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=flask_app.config['ASYNC_WSGI_THREADS'])
+        self.page_size = flask_app.config['PAGINATION_PAGE_SIZE']
+        self.page_argument_name = flask_app.config['PAGINATION_PAGE_ARGUMENT_NAME']
+        self.routes = [
+            (re.compile(r'^/service/notifications/$'), self.get_notifications),
+            (re.compile(r'^/service/notifications/(\d+)$'), self.get_notification),
+            (re.compile(r'^/service/notification_categories/$'), self.get_notification_categories),
+            (re.compile(r'^/service/notification_categories/(\d+)$'), self.get_notification_category),
+            (re.compile(r'^/service/users/$'), self.get_users),
+            (re.compile(r'^/service/users/(\d+)$'), self.get_user),
+        ]
+
+    async def start(self):
+        if self.pool is None:
+            config = self.flask_app.config
+            self.pool = await asyncpg.create_pool(
+                config['SQLALCHEMY_DATABASE_URI'],
+                min_size=config['ASYNC_DATABASE_POOL_MIN_SIZE'],
+                max_size=config['ASYNC_DATABASE_POOL_MAX_SIZE'])
+
+    async def stop(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.handle_lifespan(receive, send)
+            return
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        response = None
+        handler, handler_arguments = self.get_handler(scope)
+        if handler is not None:
+            await self.start()
+            response = await handler(scope, *handler_arguments)
+        if response is None:
+            await self.send_wsgi_response(scope, body, send)
+            return
+        status, headers, response_body = response
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': response_body})
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def get_handler(self, scope):
+        # Returns the native handler for the request or None to delegate it
+        if scope['method'] != 'GET':
+            return None, ()
+        query_arguments = dict(parse_qsl(
+            scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        if set(query_arguments) - {self.page_argument_name}:
+            return None, ()
+        try:
+            page_number = int(query_arguments.get(self.page_argument_name, 1))
+        except ValueError:
+            return None, ()
+        if page_number < 1 or b'application/x-ndjson' in self.get_header(scope, b'accept'):
+            return None, ()
+        for path_regex, handler in self.routes:
+            match = path_regex.match(scope['path'])
+            if match is not None:
+                if match.groups():
+                    return handler, (int(match.group(1)),)
+                return handler, (page_number,)
+        return None, ()
+
+    def get_header(self, scope, name):
+        for header_name, value in scope['headers']:
+            if header_name == name:
+                return value
+        return b''
+
+    def get_environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for header_name, value in scope['headers']:
+            header_name = header_name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if header_name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[header_name] = value
+            else:
+                environ['HTTP_' + header_name] = value
+        return environ
+
+    async def send_wsgi_response(self, scope, body, send):
+        # The WSGI application runs in a single thread of the pool, because the
+        # streamed responses keep the request context in that thread. The bounded
+        # queue forwards each chunk as soon as the application yields it
+        loop = asyncio.get_event_loop()
+        messages = asyncio.Queue(maxsize=WSGI_RESPONSE_QUEUE_SIZE)
+        stopped = threading.Event()
+        def put_message(message):
+            asyncio.run_coroutine_threadsafe(messages.put(message), loop).result()
+        wsgi_call = loop.run_in_executor(
+            self.executor, self.call_wsgi_app, scope, body, put_message, stopped)
+        message = None
+        try:
+            while True:
+                message = await messages.get()
+                if message is None:
+                    break
+                await send(message)
+        finally:
+            # Stop the application and keep reading until the thread finishes,
+            # so it never waits on a full queue
+            stopped.set()
+            while message is not None:
+                message = await messages.get()
+        await wsgi_call
+
+    def call_wsgi_app(self, scope, body, put_message, stopped):
+        # Puts the ASGI messages for the response and None after the last one
+        try:
+            response_start = {}
+            def start_response(status, headers, exc_info=None):
+                response_start['status'] = int(status.split(' ', 1)[0])
+                response_start['headers'] = headers
+            response_iterable = self.flask_app(self.get_environ(scope, body), start_response)
+            try:
+                put_message({
+                    'type': 'http.response.start',
+                    'status': response_start['status'],
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response_start['headers']]
+                })
+                for chunk in response_iterable:
+                    if stopped.is_set():
+                        return
+                    if chunk:
+                        put_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                put_message({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(response_iterable, 'close'):
+                    response_iterable.close()
+        finally:
+            put_message(None)
+
+    async def authenticate(self, scope):
+        # Returns the authenticated user id or None (the WSGI application
+        # generates the responses for the failed authentications)
+        authorization = self.get_header(scope, b'authorization').decode('latin-1')
+        scheme, _, credentials = authorization.partition(' ')
+        if scheme == 'Basic':
+            try:
+                name, _, password = base64.b64decode(credentials).decode('utf-8').partition(':')
+            except (ValueError, UnicodeDecodeError):
+                return None
+            with self.flask_app.app_context():
+                cached_values = verified_credentials_cache.get(name, password)
+            if cached_values is not None:
+                return cached_values['id']
+            row = await self.pool.fetchrow(
+                'SELECT id, name, password_hash, creation_date FROM "user" WHERE name = $1', name)
+            if row is None:
+                return None
+            # The password hash verification is CPU bound, so it doesn't run in the event loop
+            password_ok = await asyncio.get_event_loop().run_in_executor(
+                self.executor, password_context.verify, password, row['password_hash'])
+            if not password_ok:
+                return None
+            with self.flask_app.app_context():
+                verified_credentials_cache.set(name, password, dict(row))
+            return row['id']
+        if scheme == 'Bearer':
+            with self.flask_app.app_context():
+                try:
+                    token_data = get_token_serializer().loads(credentials)
+                except (BadSignature, SignatureExpired):
+                    return None
+            return await self.pool.fetchval('SELECT id FROM "user" WHERE id = $1', token_data['id'])
+        return None
+
+    def make_response(self, scope, data, etag=None):
+        if etag is not None:
+            if etag in parse_etags(self.get_header(scope, b'if-none-match').decode('latin-1')):
+                return HttpStatus.not_modified_304.value, [('ETag', '"{}"'.format(etag))], b''
+        with self.flask_app.app_context():
+            body = encode_json(data)
+        headers = [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))]
+        if etag is not None:
+            headers.append(('ETag', '"{}"'.format(etag)))
+        return HttpStatus.ok_200.value, headers, body
+
+    def get_request_context(self, scope):
+        # The serializers and the pagination URLs use url_for
+        return self.flask_app.request_context(self.get_environ(scope, b''))
+
+    async def get_page(self, scope, page_number, resource_for_url, serializer, count_query,
+                       objects_query, get_objects):
+        # Same page mode as PaginationHelper with include_count
+        rows = await self.pool.fetch(
+            objects_query, self.page_size, (page_number - 1) * self.page_size)
+        if page_number == 1 and len(rows) < self.page_size:
+            count = len(rows)
+        else:
+            count = await self.pool.fetchval(count_query)
+        objects = await get_objects(rows)
+        with self.get_request_context(scope):
+            previous_page_url = url_for(
+                resource_for_url, _external=True,
+                **{self.page_argument_name: page_number - 1}) if page_number > 1 else None
+            next_page_url = url_for(
+                resource_for_url, _external=True,
+                **{self.page_argument_name: page_number + 1}) \
+                if page_number * self.page_size < count else None
+            dumped_objects = serializer.dump(objects, many=True).data
+        return self.make_response(scope, {
+            'results': dumped_objects,
+            'previous': previous_page_url,
+            'next': next_page_url,
+            'count': count
+        })
+
+    def get_notification_object(self, row):
+        # Same attributes as Notification, including the nested category summary
+        notification = SimpleNamespace(**row)
+        if 'notification_category_name' in row:
+            notification.notification_category_summary = NotificationCategorySummary(
+                row['notification_category_id'], row['notification_category_name'])
+        return notification
+
+    async def get_notification_category_objects(self, rows):
+        # Loads the notifications for all the categories with a single additional query
+        notification_categories = [SimpleNamespace(notifications=[], **row) for row in rows]
+        notification_categories_by_id = {
+            notification_category.id: notification_category
+            for notification_category in notification_categories}
+        notification_rows = await self.pool.fetch(
+            'SELECT {}, n.notification_category_id FROM notification n '
+            'WHERE n.notification_category_id = ANY($1::integer[]) AND {} '
+            'ORDER BY n.message'.format(NOTIFICATION_COLUMNS, UNEXPIRED_CONDITION),
+            list(notification_categories_by_id))
+        for notification_row in notification_rows:
+            notification_category = notification_categories_by_id[notification_row['notification_category_id']]
+            notification_category.notifications.append(
+                self.get_notification_object(notification_row))
+        return notification_categories
+
+    async def get_notifications(self, scope, page_number):
+        if await self.authenticate(scope) is None:
+            return None
+        async def get_objects(rows):
+            return [self.get_notification_object(row) for row in rows]
+        return await self.get_page(
+            scope, page_number, 'service.notificationlistresource', notification_serializer,
+            'SELECT count(*) FROM notification n WHERE {}'.format(UNEXPIRED_CONDITION),
+            'SELECT {}, n.notification_category_id, n.notification_category_name '
+            'FROM notification n '
+            'WHERE {} ORDER BY n.creation_date, n.id LIMIT $1 OFFSET $2'.format(
+                NOTIFICATION_COLUMNS, UNEXPIRED_CONDITION),
+            get_objects)
+
+    async def get_notification(self, scope, id):
+        if await self.authenticate(scope) is None:
+            return None
+        row = await self.pool.fetchrow(
+            'SELECT {}, n.notification_category_id, n.notification_category_name '
+            'FROM notification n '
+            'WHERE {} AND n.id = $1'.format(NOTIFICATION_COLUMNS, UNEXPIRED_CONDITION), id)
+        if row is None:
+            return None
+        notification = self.get_notification_object(row)
+        etag = get_etag(
+            'notification', notification.id, notification.version,
+            notification.notification_category_id, notification.notification_category_name)
+        with self.get_request_context(scope):
+            dumped_notification = notification_serializer.dump(notification).data
+        return self.make_response(scope, dumped_notification, etag)
+
+    async def get_notification_categories(self, scope, page_number):
+        if await self.authenticate(scope) is None:
+            return None
+        return await self.get_page(
+            scope, page_number, 'service.notificationcategorylistresource',
+            notification_category_serializer,
+            'SELECT count(*) FROM notification_category',
+            'SELECT id, name, notification_count, version FROM notification_category '
+            'ORDER BY id LIMIT $1 OFFSET $2',
+            self.get_notification_category_objects)
+
+    async def get_notification_category(self, scope, id):
+        if await self.authenticate(scope) is None:
+            return None
+        rows = await self.pool.fetch(
+            'SELECT id, name, notification_count, version FROM notification_category WHERE id = $1', id)
+        if not rows:
+            return None
+        notification_category, = await self.get_notification_category_objects(rows)
+        # Same digest as NotificationCategory.get_notifications_digest
+        notifications_digest = await self.pool.fetchval(
+            "SELECT md5(string_agg(concat(n.id, ':', n.version), ',' ORDER BY n.id)) "
+            'FROM notification n WHERE n.notification_category_id = $1 AND {}'.format(
+            UNEXPIRED_CONDITION), id)
+        etag = get_etag(
+            'notification_category', notification_category.id, notification_category.version,
+            notification_category.notification_count,
+            notifications_digest)
+        with self.get_request_context(scope):
+            dump_result = notification_category_serializer.dump(notification_category).data
+        return self.make_response(scope, dump_result, etag)
+
+    async def get_users(self, scope, page_number):
+        if await self.authenticate(scope) is None:
+            return None
+        async def get_objects(rows):
+            return [SimpleNamespace(**row) for row in rows]
+        return await self.get_page(
+            scope, page_number, 'service.userlistresource', user_serializer,
+            'SELECT count(*) FROM "user"',
+            'SELECT id, name FROM "user" ORDER BY name, id LIMIT $1 OFFSET $2',
+            get_objects)
+
+    async def get_user(self, scope, id):
+        if await self.authenticate(scope) is None:
+            return None
+        row = await self.pool.fetchrow('SELECT id, name FROM "user" WHERE id = $1', id)
+        if row is None:
+            return None
+        with self.get_request_context(scope):
+            result = user_serializer.dump(SimpleNamespace(**row)).data
+        return self.make_response(scope, result)
+
+
+def create_asgi_app(config_filename):
+    return AsyncNotificationService(create_app(config_filename))
+
+
+# app.py already creates the Flask application for the default configuration.
+# Creating another one would initialize the extensions again
+app = AsyncNotificationService(flask_app)
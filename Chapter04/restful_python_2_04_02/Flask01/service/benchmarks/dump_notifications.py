@@ -0,0 +1,54 @@
+"""
+Compares the time to serialize notifications with the marshmallow schema
+and with the compiled serializer.
+
+Run it from the service folder with the test database configured in test_config.py:
+    python -m benchmarks.dump_notifications --notifications 10000
+"""
+import argparse
+import time
+from datetime import datetime
+from app import create_app
+from models import Notification, NotificationCategory, NotificationSchema
+from serializers import CompiledSerializer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notifications', type=int, default=10000)
+    parser.add_argument('--config', default='test_config')
+    arguments = parser.parse_args()
+    app = create_app(arguments.config)
+    # The notifications are transient, so the benchmark doesn't use the database
+    notification_category = NotificationCategory(name='Benchmark')
+    notification_category.id = 1
+    notifications = []
+    for i in range(arguments.notifications):
+        notification = Notification(
+            message='Benchmark notification {}'.format(i),
+            ttl=3600,
+            notification_category=notification_category)
+        notification.id = i + 1
+        # The database triggers set the denormalized category columns for the persisted notifications
+        notification.notification_category_id = notification_category.id
+        notification.notification_category_name = notification_category.name
+        notification.creation_date = datetime.utcnow()
+        notification.displayed_times = i
+        notification.displayed_once = i > 0
+        notifications.append(notification)
+    schema = NotificationSchema()
+    serializer = CompiledSerializer(schema)
+    with app.test_request_context():
+        start_time = time.perf_counter()
+        schema_data = schema.dump(notifications, many=True).data
+        schema_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        serializer_data = serializer.dump(notifications, many=True).data
+        serializer_time = time.perf_counter() - start_time
+    assert schema_data == serializer_data
+    print('Marshmallow schema: {:.3f} ms'.format(schema_time * 1000))
+    print('Compiled serializer: {:.3f} ms'.format(serializer_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
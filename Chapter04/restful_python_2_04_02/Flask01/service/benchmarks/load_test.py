@@ -0,0 +1,132 @@
+"""
+Compares the requests per second and the latency percentiles for running
+service builds, such as the WSGI build and the ASGI deployment mode.
+
+Start the builds with the same configuration, for example:
+    gunicorn --workers 4 --threads 8 --bind 127.0.0.1:8000 app:app
+    gunicorn --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 127.0.0.1:8001 asgi:app
+
+Then run it from the service folder:
+    python -m benchmarks.load_test --config config --seed 100 \
+        --target wsgi=http://127.0.0.1:8000 --target asgi=http://127.0.0.1:8001
+"""
+import argparse
+import http.client
+import threading
+import time
+from base64 import b64encode
+from urllib.parse import urlsplit
+from app import create_app
+from models import orm, Notification, NotificationCategory, User
+from benchmarks.patch_notification import get_percentile
+
+
+BENCHMARK_USER_NAME = 'benchmarkuser'
+BENCHMARK_USER_PASSWORD = 'B3nchm4rk!p4s5w0rd'
+DEFAULT_PATHS = [
+    '/service/notifications/',
+    '/service/notification_categories/',
+    '/service/users/',
+]
+
+
+def seed(config_filename, notifications_count):
+    # Creates the benchmark user and the notifications that don't exist yet
+    app = create_app(config_filename)
+    with app.app_context():
+        if User.query.filter_by(name=BENCHMARK_USER_NAME).first() is None:
+            user = User(name=BENCHMARK_USER_NAME)
+            user.check_password_strength_and_hash_if_ok(BENCHMARK_USER_PASSWORD)
+            user.add(user)
+        notification_category = NotificationCategory.get_or_create('Load test')
+        for i in range(notifications_count):
+            message = 'Load test notification {}'.format(i)
+            if Notification.query.filter_by(message=message).first() is None:
+                orm.session.add(Notification(
+                    message=message,
+                    ttl=86400,
+                    notification_category=notification_category))
+        orm.session.commit()
+        orm.session.remove()
+
+
+def run_load(base_url, paths, concurrency, duration):
+    # Each thread sends the requests for the paths in turn over a keep-alive connection
+    url_parts = urlsplit(base_url)
+    headers = {
+        'Accept': 'application/json',
+        'Authorization': 'Basic ' + b64encode(
+            (BENCHMARK_USER_NAME + ':' + BENCHMARK_USER_PASSWORD).encode('utf-8')).decode('utf-8')
+    }
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    end_time = time.perf_counter() + duration
+    def send_requests(thread_number):
+        connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port)
+        thread_latencies = []
+        thread_errors = 0
+        i = thread_number
+        while time.perf_counter() < end_time:
+            path = paths[i % len(paths)]
+            i += 1
+            start_time = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    thread_errors += 1
+            except (OSError, http.client.HTTPException):
+                thread_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port)
+                continue
+            thread_latencies.append(time.perf_counter() - start_time)
+        connection.close()
+        with lock:
+            latencies.extend(thread_latencies)
+            errors.append(thread_errors)
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=send_requests, args=(thread_number,))
+        for thread_number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_time = time.perf_counter() - start_time
+    return latencies, sum(errors), elapsed_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', action='append', required=True,
+        help='name=base_url for each running build')
+    parser.add_argument('--path', action='append',
+        help='Path to request (the default is the list resources)')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0,
+        help='Number of notifications to create before the load test')
+    parser.add_argument('--config', default='config')
+    arguments = parser.parse_args()
+    if arguments.seed:
+        seed(arguments.config, arguments.seed)
+    paths = arguments.path or DEFAULT_PATHS
+    for target in arguments.target:
+        name, base_url = target.split('=', 1)
+        latencies, errors, elapsed_time = run_load(
+            base_url, paths, arguments.concurrency, arguments.duration)
+        if not latencies:
+            print('{}: no successful requests ({} errors)'.format(name, errors))
+            continue
+        print('{}: {:.1f} requests/s, p50 {:.3f} ms, p99 {:.3f} ms, {} errors'.format(
+            name,
+            len(latencies) / elapsed_time,
+            get_percentile(latencies, 50) * 1000,
+            get_percentile(latencies, 99) * 1000,
+            errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures the latency for PATCH requests to a notification.
+
+Run it from the service folder with the test database configured in test_config.py:
+    python -m benchmarks.patch_notification --requests 500
+"""
+import argparse
+import statistics
+import time
+from base64 import b64encode
+from flask import json
+from app import create_app
+from models import orm, Notification, NotificationCategory, User, NotificationSchema
+
+
+BENCHMARK_USER_NAME = 'benchmarkuser'
+BENCHMARK_USER_PASSWORD = 'B3nchm4rk!p4s5w0rd'
+
+
+def get_percentile(values, percentile):
+    ordered_values = sorted(values)
+    index = min(len(ordered_values) - 1, int(round(percentile / 100 * (len(ordered_values) - 1))))
+    return ordered_values[index]
+
+
+def print_latencies(title, latencies):
+    print('{}: mean {:.3f} ms, p50 {:.3f} ms, p99 {:.3f} ms'.format(
+        title,
+        statistics.mean(latencies) * 1000,
+        get_percentile(latencies, 50) * 1000,
+        get_percentile(latencies, 99) * 1000))
+
+
+def measure(function, repetitions):
+    latencies = []
+    for i in range(repetitions):
+        start_time = time.perf_counter()
+        function(i)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--config', default='test_config')
+    arguments = parser.parse_args()
+    app = create_app(arguments.config)
+    with app.app_context():
+        orm.create_all()
+        try:
+            user = User(name=BENCHMARK_USER_NAME)
+            user.check_password_strength_and_hash_if_ok(BENCHMARK_USER_PASSWORD)
+            user.add(user)
+            notification_category = NotificationCategory(name='Benchmark')
+            notification = Notification(
+                message='Benchmark notification',
+                ttl=3600,
+                notification_category=notification_category)
+            notification.add(notification)
+            schema = NotificationSchema()
+            partial_schema = NotificationSchema(partial=True)
+            # The previous PATCH implementation dumped the whole notification and
+            # validated the dumped data to check a single field
+            legacy_latencies = measure(
+                lambda i: schema.validate(schema.dump(notification).data),
+                arguments.requests)
+            partial_latencies = measure(
+                lambda i: partial_schema.load({'displayed_times': i}),
+                arguments.requests)
+            print_latencies('Validation with dump and full validate', legacy_latencies)
+            print_latencies('Validation with partial load', partial_latencies)
+            client = app.test_client()
+            url = '/service/notifications/{}'.format(notification.id)
+            headers = {
+                'Content-Type': 'application/json',
+                'Authorization': 'Basic ' + b64encode(
+                    (BENCHMARK_USER_NAME + ':' + BENCHMARK_USER_PASSWORD).encode('utf-8')).decode('utf-8')
+            }
+            patch_latencies = measure(
+                lambda i: client.patch(url, headers=headers, data=json.dumps({'displayed_times': i})),
+                arguments.requests)
+            print_latencies('PATCH request', patch_latencies)
+        finally:
+            orm.session.remove()
+            orm.drop_all()
+
+
+if __name__ == '__main__':
+    main()
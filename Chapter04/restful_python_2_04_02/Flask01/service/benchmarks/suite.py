@@ -0,0 +1,365 @@
+"""
+Benchmark suite for the notifications API.
+
+The suite recreates the tables in the configured database, seeds users,
+notification categories and notifications, and drives a mixed read/write
+workload. It reports the requests per second, the latency percentiles and,
+in-process, the SQL statements per request for each operation.
+
+Run it from the service folder with the test database configured in test_config.py:
+    python -m benchmarks.suite --workload mixed --requests 2000 --output baseline.json
+
+Compare a later run with a saved baseline (exits with 1 if there is a regression):
+    python -m benchmarks.suite --workload mixed --requests 2000 --baseline baseline.json
+
+Drive a running server that uses the same database (use a dedicated database,
+because the suite drops the tables, and restart the server after the seeding
+so that its caches don't keep the previous data):
+    python -m benchmarks.suite --url http://127.0.0.1:8000 --concurrency 16 --duration 30
+"""
+import argparse
+import http.client
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from base64 import b64encode
+from datetime import datetime
+from urllib.parse import urlsplit
+from passlib.apps import custom_app_context as password_context
+from sqlalchemy import event
+from app import create_app
+from models import orm, Notification, NotificationCategory, User
+from benchmarks.patch_notification import get_percentile
+
+
+BENCHMARK_PASSWORD = 'B3nchm4rk!p4s5w0rd'
+SEED_BATCH_SIZE = 1000
+# The relative weight for each operation in the workloads
+WORKLOADS = {
+    'read': {
+        'list_notifications': 40,
+        'get_notification': 30,
+        'list_notification_categories': 10,
+        'get_notification_category': 10,
+        'list_users': 10,
+    },
+    'mixed': {
+        'list_notifications': 30,
+        'get_notification': 25,
+        'list_notification_categories': 5,
+        'get_notification_category': 5,
+        'list_users': 5,
+        'create_notification': 10,
+        'patch_notification': 10,
+        'increment_displayed_times': 10,
+    },
+    'write': {
+        'create_notification': 40,
+        'patch_notification': 30,
+        'increment_displayed_times': 30,
+    },
+}
+# A baseline is only comparable with a run that uses the same values for these keys
+COMPARABLE_METADATA_KEYS = (
+    'workload', 'users', 'notification_categories', 'notifications',
+    'mode', 'concurrency', 'random_seed')
+
+
+def seed(users, notification_categories, notifications):
+    # Inserts the rows with executemany statements. All the users share the
+    # same password, so the slow password hash runs only once
+    password_hash = password_context.hash(BENCHMARK_PASSWORD)
+    orm.session.execute(User.__table__.insert(), [
+        {'name': 'benchmarkuser{}'.format(i), 'password_hash': password_hash}
+        for i in range(users)])
+    orm.session.execute(NotificationCategory.__table__.insert(), [
+        {'name': 'Benchmark category {}'.format(i)}
+        for i in range(notification_categories)])
+    notification_category_ids = [id for id, in orm.session.query(NotificationCategory.id)]
+    for start in range(0, notifications, SEED_BATCH_SIZE):
+        orm.session.execute(Notification.__table__.insert(), [
+            {
+                'message': 'Benchmark notification {}'.format(i),
+                'ttl': 86400,
+                'notification_category_id': notification_category_ids[i % len(notification_category_ids)]
+            }
+            for i in range(start, min(start + SEED_BATCH_SIZE, notifications))])
+    orm.session.commit()
+    return {
+        'notification_ids': [id for id, in orm.session.query(Notification.id)],
+        'notification_category_ids': notification_category_ids,
+        'notification_category_names': [
+            'Benchmark category {}'.format(i) for i in range(notification_categories)],
+        'page_count': max(1, notifications // orm.get_app().config['PAGINATION_PAGE_SIZE']),
+    }
+
+
+class Workload():
+    def __init__(self, name, seeded_data, random_seed):
+        self.operation_names = list(WORKLOADS[name])
+        self.weights = [WORKLOADS[name][operation_name] for operation_name in self.operation_names]
+        self.seeded_data = seeded_data
+        self.random = random.Random(random_seed)
+        self.lock = threading.Lock()
+        self.created_count = 0
+
+    def get_next_request(self):
+        # Returns the operation name, the method, the path and the JSON body
+        with self.lock:
+            operation_name = self.random.choices(self.operation_names, self.weights)[0]
+            notification_id = self.random.choice(self.seeded_data['notification_ids'])
+            notification_category_id = self.random.choice(self.seeded_data['notification_category_ids'])
+            notification_category_name = self.random.choice(self.seeded_data['notification_category_names'])
+            page = self.random.randint(1, self.seeded_data['page_count'])
+            value = self.random.randint(1, 1000)
+            self.created_count += 1
+            created_count = self.created_count
+        if operation_name == 'list_notifications':
+            return operation_name, 'GET', '/service/notifications/?page={}'.format(page), None
+        if operation_name == 'get_notification':
+            return operation_name, 'GET', '/service/notifications/{}'.format(notification_id), None
+        if operation_name == 'list_notification_categories':
+            return operation_name, 'GET', '/service/notification_categories/', None
+        if operation_name == 'get_notification_category':
+            return operation_name, 'GET', \
+                '/service/notification_categories/{}'.format(notification_category_id), None
+        if operation_name == 'list_users':
+            return operation_name, 'GET', '/service/users/', None
+        if operation_name == 'create_notification':
+            return operation_name, 'POST', '/service/notifications/', {
+                'message': 'Created benchmark notification {} {}'.format(time.time(), created_count),
+                'ttl': 86400,
+                'notification_category': notification_category_name
+            }
+        if operation_name == 'patch_notification':
+            return operation_name, 'PATCH', '/service/notifications/{}'.format(notification_id), \
+                {'displayed_times': value}
+        return operation_name, 'POST', \
+            '/service/notifications/{}/displays'.format(notification_id), {'times': 1}
+
+
+def get_headers():
+    return {
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+        'Authorization': 'Basic ' + b64encode(
+            ('benchmarkuser0:' + BENCHMARK_PASSWORD).encode('utf-8')).decode('utf-8')
+    }
+
+
+def run_in_process(app, workload, requests):
+    # Sends the requests with the test client and counts the SQL statements for each one
+    client = app.test_client()
+    base_url = 'http://{}'.format(app.config.get('SERVER_NAME') or 'localhost')
+    headers = get_headers()
+    statements_count = [0]
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements_count[0] += 1
+    with app.app_context():
+        engine = orm.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    samples = []
+    start_time = time.perf_counter()
+    try:
+        for i in range(requests):
+            operation_name, method, path, body = workload.get_next_request()
+            statements_count[0] = 0
+            request_start_time = time.perf_counter()
+            response = client.open(
+                path,
+                method=method,
+                base_url=base_url,
+                headers=headers,
+                data=json.dumps(body) if body is not None else None)
+            latency = time.perf_counter() - request_start_time
+            samples.append((operation_name, latency, response.status_code >= 400, statements_count[0]))
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return samples, time.perf_counter() - start_time
+
+
+def run_over_http(url, workload, concurrency, duration):
+    # Each thread sends the requests over a keep-alive connection
+    url_parts = urlsplit(url)
+    headers = get_headers()
+    samples = []
+    lock = threading.Lock()
+    end_time = time.perf_counter() + duration
+    def send_requests():
+        connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port)
+        thread_samples = []
+        while time.perf_counter() < end_time:
+            operation_name, method, path, body = workload.get_next_request()
+            request_start_time = time.perf_counter()
+            try:
+                connection.request(
+                    method, path, headers=headers,
+                    body=json.dumps(body) if body is not None else None)
+                response = connection.getresponse()
+                response.read()
+                error = response.status >= 400
+            except (OSError, http.client.HTTPException):
+                error = True
+                connection.close()
+                connection = http.client.HTTPConnection(url_parts.hostname, url_parts.port)
+            thread_samples.append((operation_name, time.perf_counter() - request_start_time, error, None))
+        connection.close()
+        with lock:
+            samples.extend(thread_samples)
+    start_time = time.perf_counter()
+    threads = [threading.Thread(target=send_requests) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, time.perf_counter() - start_time
+
+
+def summarize(samples, elapsed_time):
+    latencies = [latency for operation_name, latency, error, statements in samples]
+    statements = [statements for operation_name, latency, error, statements in samples
+        if statements is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for operation_name, latency, error, statements in samples if error),
+        'requests_per_second': round(len(samples) / elapsed_time, 1),
+        'mean_ms': round(statistics.mean(latencies) * 1000, 3),
+        'p50_ms': round(get_percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(get_percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(get_percentile(latencies, 99) * 1000, 3),
+        'sql_statements_per_request': round(statistics.mean(statements), 2) if statements else None,
+    }
+
+
+def get_report(samples, elapsed_time, metadata):
+    operations = {}
+    for operation_name in sorted(set(sample[0] for sample in samples)):
+        operation_samples = [sample for sample in samples if sample[0] == operation_name]
+        operations[operation_name] = summarize(operation_samples, elapsed_time)
+    return {
+        'metadata': metadata,
+        'total': summarize(samples, elapsed_time),
+        'operations': operations,
+    }
+
+
+def print_report(report):
+    print('{:<30} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+        'operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'sql'))
+    rows = sorted(report['operations'].items()) + [('total', report['total'])]
+    for operation_name, result in rows:
+        print('{:<30} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>6}'.format(
+            operation_name, result['requests'], result['errors'], result['requests_per_second'],
+            result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['sql_statements_per_request'] if result['sql_statements_per_request'] is not None else '-'))
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    # Returns the regressions: the median latency grows more than the tolerance
+    # or an operation runs more SQL statements per request. The p99 latency is
+    # reported, but it is too noisy for short runs to detect regressions
+    for key in COMPARABLE_METADATA_KEYS:
+        if report['metadata'].get(key) != baseline['metadata'].get(key):
+            raise ValueError('The baseline uses a different {} ({} instead of {})'.format(
+                key, baseline['metadata'].get(key), report['metadata'].get(key)))
+    regressions = []
+    for operation_name, result in report['operations'].items():
+        baseline_result = baseline['operations'].get(operation_name)
+        if baseline_result is None:
+            continue
+        print('{:<30} p50 {:>9} -> {:>9} ms, p99 {:>9} -> {:>9} ms, sql {} -> {}'.format(
+            operation_name, baseline_result['p50_ms'], result['p50_ms'],
+            baseline_result['p99_ms'], result['p99_ms'],
+            baseline_result['sql_statements_per_request'], result['sql_statements_per_request']))
+        if result['p50_ms'] > baseline_result['p50_ms'] * (1 + tolerance):
+            regressions.append('{} median latency'.format(operation_name))
+        if result['sql_statements_per_request'] is not None and \
+                baseline_result['sql_statements_per_request'] is not None and \
+                result['sql_statements_per_request'] > baseline_result['sql_statements_per_request']:
+            regressions.append('{} SQL statements per request'.format(operation_name))
+    return regressions
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='test_config')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--notification-categories', type=int, default=20)
+    parser.add_argument('--notifications', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=1000,
+        help='Number of requests for the in-process mode')
+    parser.add_argument('--url', help='Base URL for a running server (HTTP mode)')
+    parser.add_argument('--concurrency', type=int, default=1,
+        help='Number of threads for the HTTP mode')
+    parser.add_argument('--duration', type=float, default=10,
+        help='Seconds for the HTTP mode')
+    parser.add_argument('--random-seed', type=int, default=1)
+    parser.add_argument('--output', help='Saves the report as JSON')
+    parser.add_argument('--baseline', help='Compares the report with a saved JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+        help='Allowed relative median latency growth compared with the baseline')
+    parser.add_argument('--keep-data', action='store_true',
+        help="Don't drop the tables after the run")
+    arguments = parser.parse_args()
+    app = create_app(arguments.config)
+    with app.app_context():
+        orm.drop_all()
+        orm.create_all()
+        seeded_data = seed(arguments.users, arguments.notification_categories, arguments.notifications)
+        orm.session.remove()
+    metadata = {
+        'workload': arguments.workload,
+        'users': arguments.users,
+        'notification_categories': arguments.notification_categories,
+        'notifications': arguments.notifications,
+        'mode': 'http' if arguments.url else 'in-process',
+        'concurrency': arguments.concurrency if arguments.url else 1,
+        'random_seed': arguments.random_seed,
+        'requests': arguments.requests if not arguments.url else None,
+        'duration': arguments.duration if arguments.url else None,
+        'git_commit': get_git_commit(),
+        'python_version': platform.python_version(),
+        'created': datetime.utcnow().isoformat(),
+    }
+    workload = Workload(arguments.workload, seeded_data, arguments.random_seed)
+    try:
+        if arguments.url:
+            samples, elapsed_time = run_over_http(
+                arguments.url, workload, arguments.concurrency, arguments.duration)
+        else:
+            samples, elapsed_time = run_in_process(app, workload, arguments.requests)
+    finally:
+        if not arguments.keep_data:
+            with app.app_context():
+                orm.session.remove()
+                orm.drop_all()
+    report = get_report(samples, elapsed_time, metadata)
+    print_report(report)
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(report, output_file, indent=4, sort_keys=True)
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_with_baseline(report, baseline, arguments.tolerance)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
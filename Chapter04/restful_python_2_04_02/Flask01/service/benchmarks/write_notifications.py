@@ -0,0 +1,50 @@
+"""
+Measures the latency to add and update notifications with and without
+the Flask-SQLAlchemy modifications tracking.
+
+Run it from the service folder with the test database configured in test_config.py:
+    python -m benchmarks.write_notifications --writes 500
+"""
+import argparse
+from app import create_app
+from models import orm, Notification, NotificationCategory
+from benchmarks.patch_notification import measure, print_latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--writes', type=int, default=500)
+    parser.add_argument('--config', default='test_config')
+    arguments = parser.parse_args()
+    app = create_app(arguments.config)
+    with app.app_context():
+        orm.create_all()
+        try:
+            for track_modifications in (True, False):
+                app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = track_modifications
+                # The session registers the tracking events when it is created
+                orm.session.remove()
+                notification_category = NotificationCategory.get_or_create('Benchmark')
+                notifications = []
+                def add_notification(i):
+                    notification = Notification(
+                        message='Benchmark notification {} {}'.format(track_modifications, i),
+                        ttl=3600,
+                        notification_category=notification_category)
+                    notifications.append(notification.add(notification))
+                def update_notification(i):
+                    notification = notifications[i]
+                    notification.displayed_times = i + 1
+                    notification.update()
+                add_latencies = measure(add_notification, arguments.writes)
+                update_latencies = measure(update_notification, arguments.writes)
+                title = 'with' if track_modifications else 'without'
+                print_latencies('Add {} modifications tracking'.format(title), add_latencies)
+                print_latencies('Update {} modifications tracking'.format(title), update_latencies)
+        finally:
+            orm.session.remove()
+            orm.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import click
+import csv
+import io
+import json
+import time
+from datetime import datetime
+from itertools import islice
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy.exc import SQLAlchemyError
+from models import orm, Notification, NotificationCategory
+from helpers import parse_boolean, parse_datetime
+
+
+# The columns for the exported files. The import requires the first three ones
+# and uses the server defaults for the optional ones that the file doesn't include
+NOTIFICATION_EXPORT_COLUMNS = ['message', 'ttl', 'notification_category',
+    'creation_date', 'displayed_times', 'displayed_once']
+NOTIFICATION_IMPORT_REQUIRED_COLUMNS = NOTIFICATION_EXPORT_COLUMNS[:3]
+NOTIFICATION_IMPORT_OPTIONAL_COLUMNS = NOTIFICATION_EXPORT_COLUMNS[3:]
+FORMATS = ['csv', 'ndjson']
+
+
+def echo_throughput(action, rows, elapsed_time):
+    click.echo('{} {} notifications in {:.2f} seconds ({:.0f} rows/s)'.format(
+        action, rows, elapsed_time, rows / elapsed_time if elapsed_time else 0), err=True)
+
+
+def get_csv_value(value):
+    # Writes the dates and the booleans the same way as the export
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def get_export_statement(file_format):
+    notification_table = Notification.__table__
+    # COPY trims the trailing zeros in the microseconds, which datetime.fromisoformat doesn't accept
+    creation_date = orm.func.to_char(
+        notification_table.c.creation_date, 'YYYY-MM-DD"T"HH24:MI:SS.US').label('creation_date')
+    displayed_once = notification_table.c.displayed_once
+    if file_format == 'csv':
+        # COPY writes t and f for the booleans in CSV
+        displayed_once = orm.cast(displayed_once, orm.Text).label('displayed_once')
+    return orm.select([
+        notification_table.c.message,
+        notification_table.c.ttl,
+        notification_table.c.notification_category_name.label('notification_category'),
+        creation_date,
+        notification_table.c.displayed_times,
+        displayed_once]).order_by(
+        notification_table.c.id)
+
+
+def copy_export(connection, select_statement, file_format, output):
+    # COPY streams the rows straight into the output
+    select_sql = str(select_statement.compile(
+        dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    if file_format == 'csv':
+        copy_sql = 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(select_sql)
+    else:
+        # row_to_json escapes the new lines, so a CSV with delimiter and quote
+        # characters that JSON never includes writes each object unchanged
+        copy_sql = ("COPY (SELECT row_to_json(notification_row) FROM ({}) AS notification_row) "
+            "TO STDOUT WITH (FORMAT csv, DELIMITER E'\\x01', QUOTE E'\\x02')").format(select_sql)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(copy_sql, output)
+        return cursor.rowcount
+    finally:
+        cursor.close()
+
+
+def read_records(input, file_format):
+    # Returns the columns in the file and an iterator for the records
+    if file_format == 'csv':
+        reader = csv.DictReader(input)
+        return reader.fieldnames or [], reader
+    lines = (line for line in input if line.strip())
+    first_line = next(lines, None)
+    if first_line is None:
+        return [], iter(())
+    first_record = json.loads(first_line)
+    def get_records():
+        yield first_record
+        for line in lines:
+            yield json.loads(line)
+    return list(first_record), get_records()
+
+
+def get_notification_row(record, optional_columns):
+    # Converts the record into the values for the notification table columns
+    row = {
+        'message': record['message'],
+        'ttl': int(record['ttl']),
+        'notification_category': record['notification_category'],
+    }
+    for column in optional_columns:
+        value = record[column]
+        if column == 'creation_date':
+            row[column] = value if not isinstance(value, str) else parse_datetime(value)
+        elif column == 'displayed_times':
+            row[column] = int(value)
+        else:
+            row[column] = value if isinstance(value, bool) else parse_boolean(str(value))
+    return row
+
+
+def copy_import(connection, rows, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([get_csv_value(row[column]) for column in columns])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                Notification.__tablename__, ', '.join(columns)),
+            buffer)
+    finally:
+        cursor.close()
+
+
+def get_postgresql_connection():
+    # The commands use COPY, and the schema (the expiration date index and the
+    # triggers for the denormalized columns) only exists on PostgreSQL
+    connection = orm.session.connection()
+    if connection.dialect.name != 'postgresql':
+        raise click.ClickException('The command requires a PostgreSQL database')
+    return connection
+
+
+@click.group()
+def notifications():
+    """Notifications maintenance commands."""
+    pass
+
+
+@notifications.command()
+@click.option('--batch-size', default=None, type=click.IntRange(min=1),
+    help='Maximum number of notifications deleted per transaction.')
+@click.option('--pause', default=None, type=float,
+    help='Seconds to wait between two batches.')
+@with_appcontext
+def reap(batch_size, pause):
+    """Deletes the expired notifications in bounded batches."""
+    if batch_size is None:
+        batch_size = current_app.config['EXPIRY_REAPER_BATCH_SIZE']
+    if pause is None:
+        pause = current_app.config['EXPIRY_REAPER_PAUSE']
+    total_deleted = 0
+    while True:
+        deleted = Notification.delete_expired(batch_size)
+        total_deleted += deleted
+        if deleted < batch_size:
+            break
+        # Give other transactions a chance to run between two batches
+        time.sleep(pause)
+    click.echo('Deleted {} expired notifications'.format(total_deleted))
+
+
+@notifications.command('export')
+@click.argument('output', type=click.File('w', lazy=False), default='-')
+@click.option('--format', 'file_format', type=click.Choice(FORMATS), default='csv',
+    help='Format for the exported notifications.')
+@with_appcontext
+def export_notifications(output, file_format):
+    """Exports all the notifications to a CSV or NDJSON file (the standard output by default)."""
+    start_time = time.perf_counter()
+    connection = get_postgresql_connection()
+    rows = copy_export(connection, get_export_statement(file_format), file_format, output)
+    output.flush()
+    orm.session.rollback()
+    echo_throughput('Exported', rows, time.perf_counter() - start_time)
+
+
+@notifications.command('import')
+@click.argument('input', type=click.File('r'))
+@click.option('--format', 'file_format', type=click.Choice(FORMATS), default='csv',
+    help='Format for the imported notifications.')
+@click.option('--batch-size', default=None, type=int,
+    help='Number of notifications inserted per COPY statement.')
+@with_appcontext
+def import_notifications(input, file_format, batch_size):
+    """Imports the notifications from a CSV or NDJSON file in a single transaction."""
+    if batch_size is None:
+        batch_size = current_app.config['NOTIFICATIONS_IMPORT_BATCH_SIZE']
+    start_time = time.perf_counter()
+    file_columns, records = read_records(input, file_format)
+    missing_columns = [column for column in NOTIFICATION_IMPORT_REQUIRED_COLUMNS
+        if column not in file_columns]
+    if missing_columns:
+        raise click.ClickException('Missing columns: {}'.format(', '.join(missing_columns)))
+    optional_columns = [column for column in NOTIFICATION_IMPORT_OPTIONAL_COLUMNS
+        if column in file_columns]
+    columns = ['message', 'ttl', 'notification_category_id'] + optional_columns
+    connection = get_postgresql_connection()
+    rows_count = 0
+    try:
+        while True:
+            batch = list(islice(records, batch_size))
+            if not batch:
+                break
+            try:
+                rows = [get_notification_row(record, optional_columns) for record in batch]
+            except (KeyError, TypeError, ValueError) as e:
+                raise click.ClickException('Invalid notification after row {}: {!r}'.format(
+                    rows_count, e))
+            # Resolve the category names for the whole batch at once
+            notification_category_ids = NotificationCategory.get_or_create_ids(
+                row['notification_category'] for row in rows)
+            for row in rows:
+                row['notification_category_id'] = notification_category_ids[
+                    row.pop('notification_category')]
+            copy_import(connection, rows, columns)
+            rows_count += len(rows)
+        orm.session.commit()
+    except click.ClickException:
+        orm.session.rollback()
+        raise
+    except (SQLAlchemyError, connection.dialect.dbapi.Error) as e:
+        # COPY raises the database driver errors (such as duplicate messages)
+        orm.session.rollback()
+        raise click.ClickException('The import failed and was rolled back: {}'.format(e))
+    Notification.notify_after_commit('add', Notification.__tablename__)
+    NotificationCategory.notify_after_commit('add', NotificationCategory.__tablename__)
+    echo_throughput('Imported', rows_count, time.perf_counter() - start_time)
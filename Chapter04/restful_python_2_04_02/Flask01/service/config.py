@@ -3,11 +3,73 @@ import os
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_ECHO = False
-SQLALCHEMY_TRACK_MODIFICATIONS = True
+# The models notify the changes with the ResourceAddUpdateDelete after commit
+# handlers, so the Flask-SQLAlchemy modifications tracking isn't necessary
+SQLALCHEMY_TRACK_MODIFICATIONS = False
 # Replace your_user_name with the user name you configured for the database
 # Replace your_password with the password you specified for the database user
 SQLALCHEMY_DATABASE_URI = "postgresql://{DB_USER}:{DB_PASS}@{DB_ADDR}/{DB_NAME}".format(DB_USER="your_user_name", DB_PASS="your_password", DB_ADDR="127.0.0.1", DB_NAME="flask_notifications")
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
+# Connection pool configuration (tune the size and the overflow for the number of worker threads)
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 20
+SQLALCHEMY_POOL_TIMEOUT = 30
+SQLALCHEMY_POOL_RECYCLE = 1800
+# Test the connections with a lightweight query when they are checked out from the pool
+SQLALCHEMY_POOL_PRE_PING = True
+# Additional keyword arguments for sqlalchemy.create_engine
+SQLALCHEMY_ENGINE_OPTIONS = {}
+# Read replicas for the GET, HEAD and OPTIONS requests. Add the replicas to
+# SQLALCHEMY_BINDS and their bind keys to SQLALCHEMY_REPLICA_BINDS
+SQLALCHEMY_BINDS = {}
+SQLALCHEMY_REPLICA_BINDS = []
+# Replica selection: 'round_robin' or 'least_connections'
+SQLALCHEMY_REPLICA_SELECTION = 'round_robin'
+# Skip the replicas with a replication lag greater than this number of seconds
+SQLALCHEMY_REPLICA_MAX_LAG = 5
+SQLALCHEMY_REPLICA_LAG_CHECK_INTERVAL = 1
 # Pagination configuration
 PAGINATION_PAGE_SIZE = 4
 PAGINATION_PAGE_ARGUMENT_NAME = 'page'
+PAGINATION_CURSOR_ARGUMENT_NAME = 'cursor'
+PAGINATION_ORDERING_ARGUMENT_NAME = 'ordering'
+# Query argument with the comma separated fields for the notification responses
+SPARSE_FIELDSETS_ARGUMENT_NAME = 'fields'
+# Number of rows retrieved per query for streamed responses
+PAGINATION_STREAM_BATCH_SIZE = 500
+# Authentication configuration
+# Replace your_secret_key with a random secret key to sign the authentication tokens
+SECRET_KEY = 'your_secret_key'
+AUTH_TOKEN_EXPIRATION = 600
+# Verified credentials cache (set AUTH_CACHE_MAX_SIZE to 0 to disable it)
+AUTH_CACHE_MAX_SIZE = 1024
+AUTH_CACHE_TTL = 300
+# Maximum number of notifications for a bulk create request
+BULK_CREATE_MAX_SIZE = 1000
+# Write-behind buffer for the display counters
+DISPLAY_COUNTER_BUFFER_ENABLED = False
+DISPLAY_COUNTER_FLUSH_INTERVAL = 5
+# Maximum number of displays for a single display counter increment request
+DISPLAY_COUNTER_MAX_TIMES = 1000
+# Expired notifications reaper (flask notifications reap)
+EXPIRY_REAPER_BATCH_SIZE = 1000
+EXPIRY_REAPER_PAUSE = 0.1
+# Notifications import (flask notifications import): rows per COPY or executemany batch
+NOTIFICATIONS_IMPORT_BATCH_SIZE = 10000
+# ASGI deployment mode (asgi.py): asyncpg pool and threads for the delegated WSGI requests
+ASYNC_DATABASE_POOL_MIN_SIZE = 2
+ASYNC_DATABASE_POOL_MAX_SIZE = 10
+ASYNC_WSGI_THREADS = 8
+# Per-request timings and SQL statements exposed at /service/_metrics (Prometheus format)
+REQUEST_METRICS_ENABLED = False
+# Fraction of the requests that are instrumented
+REQUEST_METRICS_SAMPLE_RATE = 0.01
+# JSON encoder for the responses ('orjson' falls back to 'json' when it isn't installed)
+JSON_ENCODER = 'orjson'
+# Response cache for the list resources ('local', 'redis' or None to disable it).
+# The local backend only invalidates the responses cached by the process that made
+# the write, so it only suits a single process: use redis with several workers
+RESPONSE_CACHE_BACKEND = None
+RESPONSE_CACHE_MAX_SIZE = 1024
+RESPONSE_CACHE_TTL = 60
+RESPONSE_CACHE_REDIS_URL = 'redis://127.0.0.1:6379/0'
@@ -4,12 +4,15 @@ from models import orm
 from flask_sqlalchemy import SQLAlchemy
 from flask import Flask
 from views import service_blueprint
+from sqlalchemy import event
+from helpers import verified_credentials_cache
 
 
 @pytest.fixture
 def application():
     # Beggining of Setup code
     app = create_app('test_config')
+    verified_credentials_cache.clear()
     with app.app_context():   
         orm.create_all()
         # End of Setup code
@@ -25,3 +28,14 @@ def application():
 @pytest.fixture
 def client(application):
     return application.test_client()
+
+
+@pytest.fixture
+def sql_statements(application):
+    # Collects the SQL statements that the engine executes while the test runs
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(orm.engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(orm.engine, 'before_cursor_execute', before_cursor_execute)
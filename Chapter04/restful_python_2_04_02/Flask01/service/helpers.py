@@ -1,37 +1,143 @@
 from flask import url_for
 from flask import current_app
+from flask import Response, stream_with_context, make_response
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload, load_only, undefer
+from serializers import CompiledSerializer
+from request_metrics import request_metrics
+from http_status import HttpStatus
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, date, timedelta
+from collections import OrderedDict
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class PaginationHelper():
-    def __init__(self, request, query, resource_for_url, key_name, schema):
+    def __init__(self, request, query, resource_for_url, key_name, schema,
+                 keyset_columns=None, include_count=True, filters=None, orderings=None):
         self.request = request
         self.query = query
         self.resource_for_url = resource_for_url
         self.key_name = key_name
         self.schema = schema
+        # The columns used to seek in cursor mode, such as (Notification.id,)
+        # or (Notification.message, Notification.id). The last column must be unique
+        self.keyset_columns = keyset_columns
+        # The page mode skips the COUNT(*) query when include_count is False
+        self.include_count = include_count
+        # Maps the argument names to functions that receive the argument value and
+        # return the SQL predicate (they raise ValueError for invalid values)
+        self.filters = filters or {}
+        # Maps the allowed values for the ordering argument to their keyset columns.
+        # A leading - in the argument value reverses the order
+        self.orderings = orderings or {}
+        self.descending = False
         self.page_size = current_app.config['PAGINATION_PAGE_SIZE']
         self.page_argument_name = current_app.config['PAGINATION_PAGE_ARGUMENT_NAME']
+        self.cursor_argument_name = current_app.config['PAGINATION_CURSOR_ARGUMENT_NAME']
+        self.ordering_argument_name = current_app.config['PAGINATION_ORDERING_ARGUMENT_NAME']
+        self.stream_batch_size = current_app.config['PAGINATION_STREAM_BATCH_SIZE']
+
+    def apply_filters_and_ordering(self):
+        # Returns an error response if an argument is not valid
+        for argument_name, get_predicate in self.filters.items():
+            value = self.request.args.get(argument_name)
+            if value is None:
+                continue
+            try:
+                predicate = get_predicate(value)
+            except ValueError:
+                response = {'error': 'The value {} is not valid for {}'.format(value, argument_name)}
+                return response, HttpStatus.bad_request_400.value
+            self.query = self.query.filter(predicate)
+        ordering = self.request.args.get(self.ordering_argument_name)
+        if ordering:
+            ordering_name = ordering[1:] if ordering.startswith('-') else ordering
+            if ordering_name not in self.orderings:
+                response = {'error': 'The ordering {} is not valid'.format(ordering)}
+                return response, HttpStatus.bad_request_400.value
+            self.keyset_columns = self.orderings[ordering_name]
+            self.descending = ordering.startswith('-')
+        return None
+
+    def get_ordered_query(self, query, ascending):
+        # The keyset values are read from the objects, so the keyset columns
+        # are loaded even when the query narrows the columns with load_only
+        query = query.options(*[undefer(column.key) for column in self.keyset_columns])
+        if ascending:
+            return query.order_by(None).order_by(*self.keyset_columns)
+        return query.order_by(None).order_by(
+            *[column.desc() for column in self.keyset_columns])
+
+    def get_seek_query(self, query, key_values, ascending):
+        # Retrieves the rows after (or before) key_values in the keyset order
+        keyset = tuple_(*self.keyset_columns)
+        if ascending:
+            query = query.filter(keyset > tuple_(*key_values))
+        else:
+            query = query.filter(keyset < tuple_(*key_values))
+        return self.get_ordered_query(query, ascending)
+
+    def get_page_url(self, **page_arguments):
+        # The URLs for the other pages keep the filtering and ordering arguments
+        arguments = {
+            argument_name: value for argument_name, value in self.request.args.items()
+            if argument_name not in (self.page_argument_name, self.cursor_argument_name)}
+        arguments.update(page_arguments)
+        return url_for(self.resource_for_url, _external=True, **arguments)
 
     def paginate_query(self):
+        error_response = self.apply_filters_and_ordering()
+        if error_response is not None:
+            return error_response
+        # The client opts in to the cursor mode by sending the cursor argument
+        # (an empty cursor retrieves the first page)
+        if self.keyset_columns is not None and \
+                self.cursor_argument_name in self.request.args:
+            return self.paginate_query_by_cursor()
         # If no page number is specified, we assume the request requires page #1
         page_number = self.request.args.get(self.page_argument_name, 1, type=int)
-        paginated_objects = self.query.paginate(
-            page_number,
-            per_page=self.page_size,
-            error_out=False)
-        objects = paginated_objects.items
-        if paginated_objects.has_prev:
-            previous_page_url = url_for(
-                self.resource_for_url, 
-                page=page_number-1, 
-                _external=True)
+        query = self.query
+        if self.keyset_columns is not None:
+            # The keyset columns provide a deterministic order for the pages
+            query = self.get_ordered_query(query, ascending=not self.descending)
+        if self.include_count:
+            paginated_objects = query.paginate(
+                page_number,
+                per_page=self.page_size,
+                error_out=False)
+            objects = paginated_objects.items
+            has_previous = paginated_objects.has_prev
+            has_next = paginated_objects.has_next
+            count = paginated_objects.total
+        else:
+            # Retrieve one extra row to know whether there is a next page
+            # without running the COUNT(*) query
+            objects = query.limit(self.page_size + 1).offset(
+                (page_number - 1) * self.page_size).all()
+            has_previous = page_number > 1
+            has_next = len(objects) > self.page_size
+            objects = objects[:self.page_size]
+            count = None
+        if has_previous:
+            previous_page_url = self.get_page_url(
+                **{self.page_argument_name: page_number-1})
         else:
             previous_page_url = None
-        if paginated_objects.has_next:
-            next_page_url = url_for(
-                self.resource_for_url,
-                page=page_number+1,
-                _external=True)
+        if has_next:
+            next_page_url = self.get_page_url(
+                **{self.page_argument_name: page_number+1})
         else:
             next_page_url = None
         dumped_objects = self.schema.dump(objects, many=True).data
@@ -39,5 +145,281 @@ class PaginationHelper():
             self.key_name: dumped_objects,
             'previous': previous_page_url,
             'next': next_page_url,
-            'count': paginated_objects.total
+            'count': count
         })
+
+    def paginate_query_by_cursor(self):
+        cursor = self.request.args.get(self.cursor_argument_name, '')
+        if cursor:
+            try:
+                key_values, forward = self.decode_cursor(cursor)
+            except (ValueError, TypeError, KeyError, binascii.Error):
+                response = {'error': 'The cursor {} is not valid'.format(cursor)}
+                return response, HttpStatus.bad_request_400.value
+        else:
+            key_values, forward = None, True
+        # The forward direction follows the requested order
+        ascending = forward != self.descending
+        if key_values is not None:
+            query = self.get_seek_query(self.query, key_values, ascending)
+        else:
+            query = self.get_ordered_query(self.query, ascending)
+        # Retrieve one extra row to know whether there are more rows in the seek direction
+        objects = query.limit(self.page_size + 1).all()
+        has_more = len(objects) > self.page_size
+        objects = objects[:self.page_size]
+        if forward:
+            has_previous = key_values is not None
+            has_next = has_more
+        else:
+            objects.reverse()
+            has_previous = has_more
+            has_next = True
+        if has_previous and objects:
+            previous_page_url = self.get_page_url(
+                **{self.cursor_argument_name: self.encode_cursor(objects[0], forward=False)})
+        else:
+            previous_page_url = None
+        if has_next and objects:
+            next_page_url = self.get_page_url(
+                **{self.cursor_argument_name: self.encode_cursor(objects[-1], forward=True)})
+        else:
+            next_page_url = None
+        dumped_objects = self.schema.dump(objects, many=True).data
+        # The cursor mode never runs the COUNT(*) query
+        return ({
+            self.key_name: dumped_objects,
+            'previous': previous_page_url,
+            'next': next_page_url,
+            'count': None
+        })
+
+    def encode_cursor(self, obj, forward):
+        key_values = []
+        for column in self.keyset_columns:
+            value = getattr(obj, column.key)
+            if isinstance(value, datetime):
+                value = value.isoformat()
+            key_values.append(value)
+        cursor = json.dumps({'k': key_values, 'f': forward})
+        return urlsafe_b64encode(cursor.encode('utf-8')).decode('utf-8')
+
+    def decode_cursor(self, cursor):
+        cursor_dict = json.loads(urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+        key_values = cursor_dict['k']
+        if len(key_values) != len(self.keyset_columns):
+            raise ValueError('The cursor does not match the keyset columns')
+        for index, column in enumerate(self.keyset_columns):
+            python_type = column.type.python_type
+            if python_type is datetime:
+                key_values[index] = datetime.fromisoformat(key_values[index])
+            elif type(key_values[index]) is not python_type:
+                # The database would reject the value when the query runs
+                # (the exact type check also rejects the booleans for the integers)
+                raise ValueError('The cursor value for {} is not a {}'.format(
+                    column.name, python_type.__name__))
+        return key_values, bool(cursor_dict['f'])
+
+    def is_stream_requested(self):
+        # The client opts in to the streamed response with the Accept header
+        best_mimetype = self.request.accept_mimetypes.best_match(
+            ['application/json', 'application/x-ndjson'])
+        return self.keyset_columns is not None and \
+            best_mimetype == 'application/x-ndjson'
+
+    def stream_query(self):
+        # Walk the whole query in keyset batches and serialize each row as a
+        # newline delimited JSON line, so that the peak memory usage depends
+        # on the batch size instead of the number of rows
+        error_response = self.apply_filters_and_ordering()
+        if error_response is not None:
+            return error_response
+        def generate_lines():
+            ascending = not self.descending
+            objects = self.get_ordered_query(self.query, ascending).limit(
+                self.stream_batch_size).all()
+            while objects:
+                for obj in objects:
+                    yield encode_json(self.schema.dump(obj).data)
+                last_key_values = [getattr(objects[-1], column.key)
+                    for column in self.keyset_columns]
+                objects = self.get_seek_query(self.query, last_key_values, ascending).limit(
+                    self.stream_batch_size).all()
+        return Response(
+            stream_with_context(generate_lines()),
+            mimetype='application/x-ndjson')
+
+
+def parse_boolean(value):
+    # Parses the boolean values for the filters in the query arguments
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError('{} is not a boolean value'.format(value))
+
+
+def parse_datetime(value):
+    # Parses the ISO 8601 date and time values for the filters in the query arguments
+    return datetime.fromisoformat(value)
+
+
+def parse_seconds(value):
+    # Parses the durations in seconds for the filters in the query arguments.
+    # The ttl is a 32-bit integer, so a longer duration can't match any
+    # notification (and it could overflow timedelta or the database timestamps)
+    seconds = int(value)
+    if abs(seconds) > 2147483647:
+        raise ValueError('{} is out of the range for a duration in seconds'.format(value))
+    return timedelta(seconds=seconds)
+
+
+def default_json_value(value):
+    # Encodes the values that the json module doesn't support natively
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+@request_metrics.timed('encode')
+def encode_json(data):
+    # Returns the UTF-8 encoded JSON for data, ending with a new line.
+    # JSON_ENCODER selects 'orjson' (falls back to 'json' when it isn't installed) or 'json'
+    settings = current_app.config.get('RESTFUL_JSON', {})
+    if current_app.config['JSON_ENCODER'] == 'orjson' and orjson is not None and not settings:
+        # The json module converts the non string keys (such as the bulk create errors indexes)
+        options = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+        if current_app.debug:
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, default=default_json_value, option=options)
+    settings = dict(settings)
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    settings.setdefault('default', default_json_value)
+    return (json.dumps(data, **settings) + '\n').encode('utf-8')
+
+
+class SparseFieldsets():
+    def __init__(self, schema_class, model, required_columns=(), field_columns=None):
+        self.schema_class = schema_class
+        self.model = model
+        # The columns that the resources always need, such as the primary key
+        self.required_columns = required_columns
+        # The columns for the fields that don't map to a column or a relationship
+        # with the same name, such as the nested fields built from local columns
+        self.field_columns = field_columns or {}
+        self.lock = threading.Lock()
+        # The compiled serializers for each requested field set
+        self.serializers = {}
+
+    def parse_fields(self, request):
+        # Returns the requested field names or None for all the fields
+        value = request.args.get(current_app.config['SPARSE_FIELDSETS_ARGUMENT_NAME'])
+        if value is None:
+            return None
+        field_names = frozenset(
+            field_name.strip() for field_name in value.split(',') if field_name.strip())
+        unknown_field_names = field_names - set(self.schema_class._declared_fields)
+        if not field_names or unknown_field_names:
+            raise ValueError('The fields {} are not valid'.format(value))
+        return field_names
+
+    def get_serializer(self, field_names):
+        with self.lock:
+            serializer = self.serializers.get(field_names)
+            if serializer is None:
+                only = tuple(sorted(field_names)) if field_names is not None else None
+                serializer = CompiledSerializer(self.schema_class(only=only))
+                self.serializers[field_names] = serializer
+        return serializer
+
+    def get_query_options(self, field_names):
+        # Loads the relationships for the requested nested fields and
+        # narrows the SELECT to the requested columns
+        mapper = self.model.__mapper__
+        if field_names is None:
+            field_names = frozenset(self.schema_class._declared_fields)
+            column_keys = None
+        else:
+            column_keys = [column.key for column in self.required_columns]
+            column_keys.extend(
+                field_name for field_name in field_names
+                if field_name in mapper.column_attrs)
+        options = []
+        for field_name in sorted(field_names):
+            if field_name in self.field_columns:
+                if column_keys is not None:
+                    column_keys.extend(column.key for column in self.field_columns[field_name])
+            elif field_name in mapper.relationships:
+                relationship = mapper.relationships[field_name]
+                options.append(joinedload(getattr(self.model, field_name)))
+                if column_keys is not None:
+                    column_keys.extend(column.key for column in relationship.local_columns)
+        if column_keys is not None:
+            options.append(load_only(*column_keys))
+        return options
+
+
+def get_etag(*version_values):
+    # Builds a strong entity tag from the values that identify a representation
+    version_string = ':'.join(str(value) for value in version_values)
+    return hashlib.sha1(version_string.encode('utf-8')).hexdigest()
+
+
+def make_not_modified_response(etag):
+    response = make_response()
+    response.status_code = HttpStatus.not_modified_304.value
+    response.set_etag(etag)
+    return response
+
+
+class VerifiedCredentialsCache():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        # The cache saves keyed digests for the passwords (it doesn't keep the actual passwords)
+        self.digest_key = os.urandom(32)
+
+    def get_password_digest(self, password):
+        return hmac.new(self.digest_key, password.encode('utf-8'), hashlib.sha256).digest()
+
+    def get(self, name, password):
+        # Returns the cached values for the user if the password was already verified
+        if current_app.config['AUTH_CACHE_MAX_SIZE'] <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(name)
+            if entry is None:
+                return None
+            password_digest, expiration_time, values = entry
+            if expiration_time <= time.monotonic():
+                del self.entries[name]
+                return None
+            self.entries.move_to_end(name)
+        if hmac.compare_digest(password_digest, self.get_password_digest(password)):
+            return values
+        return None
+
+    def set(self, name, password, values):
+        max_size = current_app.config['AUTH_CACHE_MAX_SIZE']
+        if max_size <= 0:
+            return
+        expiration_time = time.monotonic() + current_app.config['AUTH_CACHE_TTL']
+        entry = (self.get_password_digest(password), expiration_time, values)
+        with self.lock:
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+            # Evict the least recently used entries
+            while len(self.entries) > max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+verified_credentials_cache = VerifiedCredentialsCache()
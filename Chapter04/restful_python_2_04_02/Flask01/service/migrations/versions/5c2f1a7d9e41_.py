@@ -0,0 +1,25 @@
+"""empty message
+
+Revision ID: 5c2f1a7d9e41
+Revises: 2029a0a9475f
+Create Date: 2018-10-24 18:42:10.518231
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f1a7d9e41'
+down_revision = '2029a0a9475f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_notification_expiration_date', 'notification',
+        [sa.text("(creation_date + ttl * INTERVAL '1 second')")], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_notification_expiration_date', table_name='notification')
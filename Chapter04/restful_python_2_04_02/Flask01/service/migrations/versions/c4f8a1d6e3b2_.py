@@ -0,0 +1,124 @@
+"""empty message
+
+Revision ID: c4f8a1d6e3b2
+Revises: b7e3c9d2a4f6
+Create Date: 2018-10-29 09:42:17.604318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4f8a1d6e3b2'
+down_revision = 'b7e3c9d2a4f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('notification_category', sa.Column('notification_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('notification', sa.Column('notification_category_name', sa.String(length=150), nullable=True))
+    # Backfill the counters and the denormalized names before the triggers maintain them
+    op.execute('''
+        UPDATE notification_category SET notification_count = counts.count
+        FROM (SELECT notification_category_id, count(*) AS count
+            FROM notification GROUP BY notification_category_id) AS counts
+        WHERE id = counts.notification_category_id
+    ''')
+    op.execute('''
+        UPDATE notification SET notification_category_name = notification_category.name
+        FROM notification_category
+        WHERE notification_category.id = notification.notification_category_id
+    ''')
+    op.alter_column('notification', 'notification_category_name', nullable=False)
+    op.execute('''
+        CREATE OR REPLACE FUNCTION set_notification_category_name() RETURNS trigger AS $$
+        BEGIN
+            SELECT name INTO NEW.notification_category_name
+                FROM notification_category WHERE id = NEW.notification_category_id;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION count_inserted_notifications() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM notification_category
+                WHERE id IN (SELECT notification_category_id FROM inserted_notifications)
+                ORDER BY id FOR NO KEY UPDATE;
+            UPDATE notification_category SET notification_count = notification_count + counts.count
+                FROM (SELECT notification_category_id, count(*) AS count
+                    FROM inserted_notifications GROUP BY notification_category_id) AS counts
+                WHERE id = counts.notification_category_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION count_deleted_notifications() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM notification_category
+                WHERE id IN (SELECT notification_category_id FROM deleted_notifications)
+                ORDER BY id FOR NO KEY UPDATE;
+            UPDATE notification_category SET notification_count = notification_count - counts.count
+                FROM (SELECT notification_category_id, count(*) AS count
+                    FROM deleted_notifications GROUP BY notification_category_id) AS counts
+                WHERE id = counts.notification_category_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION count_moved_notification() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM notification_category
+                WHERE id IN (OLD.notification_category_id, NEW.notification_category_id)
+                ORDER BY id FOR NO KEY UPDATE;
+            UPDATE notification_category SET notification_count = notification_count +
+                CASE WHEN id = NEW.notification_category_id THEN 1 ELSE -1 END
+                WHERE id IN (OLD.notification_category_id, NEW.notification_category_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION propagate_notification_category_name() RETURNS trigger AS $$
+        BEGIN
+            UPDATE notification SET notification_category_name = NEW.name
+                WHERE notification_category_id = NEW.id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE TRIGGER notification_set_category_name
+            BEFORE INSERT OR UPDATE OF notification_category_id ON notification
+            FOR EACH ROW EXECUTE PROCEDURE set_notification_category_name();
+        CREATE TRIGGER notification_count_inserted
+            AFTER INSERT ON notification REFERENCING NEW TABLE AS inserted_notifications
+            FOR EACH STATEMENT EXECUTE PROCEDURE count_inserted_notifications();
+        CREATE TRIGGER notification_count_deleted
+            AFTER DELETE ON notification REFERENCING OLD TABLE AS deleted_notifications
+            FOR EACH STATEMENT EXECUTE PROCEDURE count_deleted_notifications();
+        CREATE TRIGGER notification_count_moved
+            AFTER UPDATE OF notification_category_id ON notification
+            FOR EACH ROW WHEN (OLD.notification_category_id IS DISTINCT FROM NEW.notification_category_id)
+            EXECUTE PROCEDURE count_moved_notification();
+        CREATE TRIGGER notification_category_propagate_name
+            AFTER UPDATE OF name ON notification_category
+            FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+            EXECUTE PROCEDURE propagate_notification_category_name();
+    ''')
+
+
+def downgrade():
+    op.execute('''
+        DROP TRIGGER notification_category_propagate_name ON notification_category;
+        DROP TRIGGER notification_count_moved ON notification;
+        DROP TRIGGER notification_count_deleted ON notification;
+        DROP TRIGGER notification_count_inserted ON notification;
+        DROP TRIGGER notification_set_category_name ON notification;
+        DROP FUNCTION propagate_notification_category_name();
+        DROP FUNCTION count_moved_notification();
+        DROP FUNCTION count_deleted_notifications();
+        DROP FUNCTION count_inserted_notifications();
+        DROP FUNCTION set_notification_category_name();
+    ''')
+    op.drop_column('notification', 'notification_category_name')
+    op.drop_column('notification_category', 'notification_count')
@@ -1,29 +1,106 @@
 from marshmallow import Schema, fields, pre_load
 from marshmallow import validate
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
 from passlib.apps import custom_app_context as password_context
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm import sessionmaker as orm_sessionmaker
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy import DDL, FetchedValue, event
+from sqlalchemy.exc import DataError, OperationalError
+from collections import namedtuple
+from datetime import timedelta
+from helpers import verified_credentials_cache
+from response_cache import response_cache
+from replica_routing import RoutingSession
+import atexit
 import re
+import threading
+import time
 
 
-orm = SQLAlchemy()
+class ConfigurableEngineSQLAlchemy(SQLAlchemy):
+    def apply_pool_defaults(self, app, options):
+        # Besides the SQLALCHEMY_POOL_* keys, read the pre-ping flag and
+        # any other create_engine options from the configuration
+        super().apply_pool_defaults(app, options)
+        if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+            options['pool_pre_ping'] = True
+        options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+
+    def create_session(self, options):
+        # The routing session sends the reads for safe requests to the replicas
+        return orm_sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# The instances keep their state after a commit, so the write paths
+# can serialize them without reading them again
+orm = ConfigurableEngineSQLAlchemy(session_options={'expire_on_commit': False})
 ma = Marshmallow()
 
 
-class ResourceAddUpdateDelete():   
+def is_unique_violation(error):
+    # 23505 is the PostgreSQL SQLSTATE code for unique_violation
+    return getattr(error.orig, 'pgcode', None) == '23505' or \
+        'UNIQUE constraint failed' in str(error.orig)
+
+
+def get_expiration_date_expression(creation_date, ttl):
+    # The ttl is expressed in seconds. The index and the queries must use
+    # the same expression so that PostgreSQL can use the index
+    return creation_date + ttl * orm.literal_column("INTERVAL '1 second'", type_=orm.Interval)
+
+
+class ResourceAddUpdateDelete():
+    # The handlers run after each commit that modifies the resources. They
+    # receive the operation ('add', 'update' or 'delete'), the table name and
+    # the resource (None for the statements that modify many rows). The changes
+    # are already committed, so a failed handler is logged and doesn't fail the write
+    after_commit_handlers = []
+
+    @classmethod
+    def on_after_commit(cls, handler):
+        cls.after_commit_handlers.append(handler)
+        return handler
+
+    @classmethod
+    def notify_after_commit(cls, operation, table_name, resource=None):
+        for handler in cls.after_commit_handlers:
+            try:
+                handler(operation, table_name, resource)
+            except Exception:
+                current_app.logger.exception(
+                    'The after commit handler {} failed for {}'.format(handler.__name__, table_name))
+
     def add(self, resource):
         orm.session.add(resource)
-        return orm.session.commit()
+        orm.session.commit()
+        self.notify_after_commit('add', resource.__tablename__, resource)
+        return resource
 
     def update(self):
-        return orm.session.commit()
+        orm.session.commit()
+        self.notify_after_commit('update', self.__tablename__, self)
+        return self
 
     def delete(self, resource):
         orm.session.delete(resource)
-        return orm.session.commit()
+        result = orm.session.commit()
+        self.notify_after_commit('delete', resource.__tablename__, resource)
+        return result
+
+
+@ResourceAddUpdateDelete.on_after_commit
+def invalidate_response_cache(operation, table_name, resource):
+    response_cache.invalidate(table_name)
 
 
 class User(orm.Model, ResourceAddUpdateDelete):
+    # Retrieve the server defaults with RETURNING in the INSERT statement
+    __mapper_args__ = {'eager_defaults': True}
     id = orm.Column(orm.Integer, primary_key=True)
     name = orm.Column(orm.String(50), unique=True, nullable=False)
     # I save the hash for the password (I don't persist the actual password)
@@ -47,32 +124,115 @@ class User(orm.Model, ResourceAddUpdateDelete):
         if re.search(r"[ !#$%&'()*+,-./[\\\]^_`{|}~"+r'"]', password) is None:
             return 'The password must include at least one symbol.', False
         self.password_hash = password_context.hash(password)
+        # Previously verified passwords for the user are no longer valid
+        verified_credentials_cache.invalidate(self.name)
         return '', True
 
+    def get_cache_values(self):
+        return dict(
+            id=self.id,
+            name=self.name,
+            password_hash=self.password_hash,
+            creation_date=self.creation_date)
+
+    @classmethod
+    def from_cache_values(cls, values):
+        # Build a persistent instance from the cached values without querying the database
+        user = cls(name=values['name'])
+        user.id = values['id']
+        user.password_hash = values['password_hash']
+        user.creation_date = values['creation_date']
+        make_transient_to_detached(user)
+        return orm.session.merge(user, load=False)
+
     def __init__(self, name):
         self.name = name
 
 
+# The nested notification category for the notification dumps (the URL uses the id)
+NotificationCategorySummary = namedtuple('NotificationCategorySummary', ['id', 'name'])
+
+
 class Notification(orm.Model, ResourceAddUpdateDelete):
     id = orm.Column(orm.Integer, primary_key=True)
     message = orm.Column(orm.String(250), unique=True, nullable=False)
     ttl = orm.Column(orm.Integer, nullable=False)
     creation_date = orm.Column(orm.TIMESTAMP, server_default=orm.func.current_timestamp(), nullable=False)
     notification_category_id = orm.Column(orm.Integer, orm.ForeignKey('notification_category.id', ondelete='CASCADE'), nullable=False)
-    notification_category = orm.relationship('NotificationCategory', backref=orm.backref('notifications', lazy='dynamic' , order_by='Notification.message'))
+    notification_category = orm.relationship('NotificationCategory')
     displayed_times = orm.Column(orm.Integer, nullable=False, server_default='0')
     displayed_once = orm.Column(orm.Boolean, nullable=False, server_default='false')
+    # Denormalized category name. The database triggers keep it in sync for all the
+    # write paths, including the bulk statements and COPY, so the dumps don't join the category
+    notification_category_name = orm.Column(orm.String(150), nullable=False,
+        server_default=FetchedValue(), server_onupdate=FetchedValue())
+    # The version changes with each update (the ETag uses it). It isn't a
+    # version_id_col, because the display counter increments also change it
+    # and they must not make the concurrent PATCH requests fail
+    version = orm.Column(orm.Integer, nullable=False, server_default='1')
+    # Retrieve the server defaults with RETURNING in the INSERT statement
+    __mapper_args__ = {'eager_defaults': True}
+    __table_args__ = (
+        orm.Index('ix_notification_expiration_date',
+            get_expiration_date_expression(creation_date, ttl)),
+        # Supports the notifications backref (filters by category and orders by message)
+        orm.Index('ix_notification_notification_category_id_message',
+            notification_category_id, message),
+        # Supports the deterministic ordering for the notifications list pagination
+        orm.Index('ix_notification_creation_date_id',
+            creation_date, id),
+    )
+
+    @hybrid_property
+    def expiration_date(self):
+        return self.creation_date + timedelta(seconds=self.ttl)
+
+    @expiration_date.expression
+    def expiration_date(cls):
+        return get_expiration_date_expression(cls.creation_date, cls.ttl)
+
+    @property
+    def notification_category_summary(self):
+        # The nested category in the notification dumps only needs the id and the name
+        return NotificationCategorySummary(self.notification_category_id, self.notification_category_name)
 
     @classmethod
-    def is_message_unique(cls, id, message):
-        existing_notification = cls.query.filter_by(message=message).first()
-        if existing_notification is None:
-            return True
-        else:
-            if existing_notification.id == id:
-                return True
-            else:
-                return False
+    def get_unexpired_query(cls):
+        return cls.query.filter(cls.expiration_date > orm.func.localtimestamp())
+
+    @classmethod
+    def delete_expired(cls, batch_size):
+        # Delete a bounded chunk of expired rows per transaction. SKIP LOCKED
+        # avoids waiting for the rows that other transactions are updating
+        notification_table = cls.__table__
+        expired_ids = orm.select([notification_table.c.id]).where(
+            cls.expiration_date <= orm.func.localtimestamp()).limit(
+            batch_size).with_for_update(skip_locked=True)
+        delete_statement = notification_table.delete().where(
+            notification_table.c.id.in_(expired_ids))
+        result = orm.session.execute(delete_statement)
+        orm.session.commit()
+        if result.rowcount:
+            cls.notify_after_commit('delete', cls.__tablename__)
+        return result.rowcount
+
+    @classmethod
+    def increment_displayed_times(cls, id, times):
+        # A single atomic UPDATE avoids losing increments under concurrency.
+        # The expired notifications are gone, even before the reaper deletes them
+        notification_table = cls.__table__
+        update_statement = notification_table.update().where(orm.and_(
+            notification_table.c.id == id,
+            cls.expiration_date > orm.func.localtimestamp())).values(
+            displayed_times=notification_table.c.displayed_times + times,
+            displayed_once=True,
+            version=notification_table.c.version + 1).returning(
+            notification_table.c.displayed_times,
+            notification_table.c.displayed_once)
+        row = orm.session.execute(update_statement).first()
+        orm.session.commit()
+        cls.notify_after_commit('update', cls.__tablename__)
+        return row
 
     def __init__(self, message, ttl, notification_category):
         self.message = message
@@ -80,23 +240,263 @@ class Notification(orm.Model, ResourceAddUpdateDelete):
         self.notification_category = notification_category
 
 
+@event.listens_for(Notification, 'before_update')
+def increment_notification_version(mapper, connection, target):
+    # The UPDATE statement increments the version in the database, so
+    # it doesn't lose the increments from the concurrent statements
+    if orm.object_session(target).is_modified(target, include_collections=False):
+        target.version = Notification.version + 1
+
+
+class DisplayCounterBuffer():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending_increments = {}
+        self.worker = None
+
+    def add(self, id, times):
+        with self.lock:
+            self.pending_increments[id] = self.pending_increments.get(id, 0) + times
+
+    def flush(self):
+        # Apply all the coalesced increments with a single executemany UPDATE
+        with self.lock:
+            pending_increments = self.pending_increments
+            self.pending_increments = {}
+        if not pending_increments:
+            return 0
+        notification_table = Notification.__table__
+        update_statement = notification_table.update().where(orm.and_(
+            notification_table.c.id == orm.bindparam('notification_id'),
+            Notification.expiration_date > orm.func.localtimestamp())).values(
+            displayed_times=notification_table.c.displayed_times + orm.bindparam('times'),
+            displayed_once=True,
+            version=notification_table.c.version + 1)
+        try:
+            orm.session.execute(update_statement, [
+                {'notification_id': id, 'times': times}
+                for id, times in pending_increments.items()])
+            orm.session.commit()
+        except OperationalError:
+            orm.session.rollback()
+            # Put the increments back, so the next flush applies them
+            # after the database is available again
+            with self.lock:
+                for id, times in pending_increments.items():
+                    self.pending_increments[id] = self.pending_increments.get(id, 0) + times
+            raise
+        except DataError:
+            orm.session.rollback()
+            # The increments would fail the same way in every flush (for
+            # example, a counter out of the integer range), so they are dropped
+            current_app.logger.exception(
+                'Dropped the display counter increments for {} notifications'.format(
+                    len(pending_increments)))
+            return 0
+        except Exception:
+            orm.session.rollback()
+            raise
+        Notification.notify_after_commit('update', Notification.__tablename__)
+        return len(pending_increments)
+
+    def flush_in_app_context(self, app):
+        # A flush that fails with a transient error keeps the increments for the next one, so it's only logged
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception('Could not flush the display counter increments')
+            finally:
+                orm.session.remove()
+
+    def start(self, app):
+        # Flush the buffer every DISPLAY_COUNTER_FLUSH_INTERVAL seconds in a daemon
+        # thread, and once more when the process exits
+        if self.worker is not None:
+            return
+        def flush_periodically():
+            while True:
+                time.sleep(app.config['DISPLAY_COUNTER_FLUSH_INTERVAL'])
+                self.flush_in_app_context(app)
+        self.worker = threading.Thread(target=flush_periodically, daemon=True)
+        self.worker.start()
+        atexit.register(self.flush_in_app_context, app)
+
+
+display_counter_buffer = DisplayCounterBuffer()
+
+
 class NotificationCategory(orm.Model, ResourceAddUpdateDelete):
     id = orm.Column(orm.Integer, primary_key=True)
     name = orm.Column(orm.String(150), unique=True, nullable=False)
+    # The database triggers maintain the number of notifications in the category
+    notification_count = orm.Column(orm.Integer, nullable=False, server_default='0')
+    # The ORM increments the version for each update (the ETag uses it)
+    version = orm.Column(orm.Integer, nullable=False, server_default='1')
+    # The notifications relationship uses a regular collection instead of a dynamic
+    # query so that list resources can eager load it with selectinload. It only
+    # includes the unexpired notifications, so it is read-only (the database
+    # deletes the notifications with the category)
+    notifications = orm.relationship(Notification, lazy='select', order_by=Notification.message,
+        primaryjoin=orm.and_(
+            id == Notification.notification_category_id,
+            Notification.expiration_date > orm.func.localtimestamp()),
+        viewonly=True)
+    # Retrieve the server defaults with RETURNING in the INSERT statement
+    __mapper_args__ = {'eager_defaults': True, 'version_id_col': version}
 
     @classmethod
-    def is_name_unique(cls, id, name):
-        existing_notification_category = cls.query.filter_by(name=name).first()
-        if existing_notification_category is None:
-            return True
-        else:
-            if existing_notification_category.id == id:
-                return True
-            else:
-                return False
-    
+    def get_or_create(cls, name):
+        notification_category = cls.query.filter_by(name=name).first()
+        if notification_category is not None:
+            return notification_category
+        # INSERT ... ON CONFLICT DO NOTHING doesn't fail when a concurrent
+        # request creates the same category after the previous query
+        insert_statement = postgresql_insert(cls.__table__).values(
+            name=name).on_conflict_do_nothing(
+            index_elements=['name']).returning(cls.__table__.c.id)
+        id = orm.session.execute(insert_statement).scalar()
+        if id is None:
+            return cls.query.filter_by(name=name).one()
+        # Build a persistent instance for the new row without querying the database
+        notification_category = cls(name=name)
+        notification_category.id = id
+        notification_category.version = 1
+        make_transient_to_detached(notification_category)
+        return orm.session.merge(notification_category, load=False)
+
+    @classmethod
+    def get_or_create_ids(cls, names):
+        # Resolves many category names into ids with one query and a single
+        # executemany INSERT for the missing names. Returns a {name: id} dictionary
+        notification_category_table = cls.__table__
+        names = set(names)
+        def get_ids():
+            return dict(orm.session.execute(orm.select([
+                notification_category_table.c.name,
+                notification_category_table.c.id]).where(
+                notification_category_table.c.name.in_(names))).fetchall())
+        ids = get_ids()
+        missing_names = names.difference(ids)
+        if not missing_names:
+            return ids
+        # ON CONFLICT DO NOTHING skips the names that concurrent requests insert
+        insert_statement = postgresql_insert(notification_category_table).on_conflict_do_nothing(
+            index_elements=['name'])
+        orm.session.execute(insert_statement, [{'name': name} for name in missing_names])
+        return get_ids()
+
+    def get_notifications_digest(self):
+        # Summarizes the id and version for all the notifications in the category
+        # with a single query, without loading and serializing them
+        notifications_versions = orm.func.concat(Notification.id, ':', Notification.version)
+        return orm.session.query(orm.func.md5(orm.func.string_agg(
+            notifications_versions, aggregate_order_by(',', Notification.id)))).filter(
+            Notification.notification_category_id == self.id,
+            Notification.expiration_date > orm.func.localtimestamp()).scalar()
+
     def __init__(self, name):
         self.name = name
+        # A new category has no notifications, so there is no need to load them after the insert
+        self.notifications = []
+
+
+# The triggers keep notification_category.notification_count and
+# notification.notification_category_name up to date for every statement.
+# The statement triggers aggregate the transition tables, so a bulk INSERT
+# or COPY updates each category once. They lock the categories in id order
+# to avoid deadlocks between concurrent writers. FOR NO KEY UPDATE is the lock
+# that the UPDATE takes, and it doesn't conflict with the FOR KEY SHARE lock
+# that the foreign key check for the inserted notifications already holds
+NOTIFICATION_TRIGGER_FUNCTIONS_DDL = DDL('''
+CREATE OR REPLACE FUNCTION set_notification_category_name() RETURNS trigger AS $$
+BEGIN
+    SELECT name INTO NEW.notification_category_name
+        FROM notification_category WHERE id = NEW.notification_category_id;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_inserted_notifications() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM notification_category
+        WHERE id IN (SELECT notification_category_id FROM inserted_notifications)
+        ORDER BY id FOR NO KEY UPDATE;
+    UPDATE notification_category SET notification_count = notification_count + counts.count
+        FROM (SELECT notification_category_id, count(*) AS count
+            FROM inserted_notifications GROUP BY notification_category_id) AS counts
+        WHERE id = counts.notification_category_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_deleted_notifications() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM notification_category
+        WHERE id IN (SELECT notification_category_id FROM deleted_notifications)
+        ORDER BY id FOR NO KEY UPDATE;
+    UPDATE notification_category SET notification_count = notification_count - counts.count
+        FROM (SELECT notification_category_id, count(*) AS count
+            FROM deleted_notifications GROUP BY notification_category_id) AS counts
+        WHERE id = counts.notification_category_id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION count_moved_notification() RETURNS trigger AS $$
+BEGIN
+    PERFORM 1 FROM notification_category
+        WHERE id IN (OLD.notification_category_id, NEW.notification_category_id)
+        ORDER BY id FOR NO KEY UPDATE;
+    UPDATE notification_category SET notification_count = notification_count +
+        CASE WHEN id = NEW.notification_category_id THEN 1 ELSE -1 END
+        WHERE id IN (OLD.notification_category_id, NEW.notification_category_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION propagate_notification_category_name() RETURNS trigger AS $$
+BEGIN
+    UPDATE notification SET notification_category_name = NEW.name
+        WHERE notification_category_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+''')
+NOTIFICATION_TRIGGERS_DDL = DDL('''
+CREATE TRIGGER notification_set_category_name
+    BEFORE INSERT OR UPDATE OF notification_category_id ON notification
+    FOR EACH ROW EXECUTE PROCEDURE set_notification_category_name();
+CREATE TRIGGER notification_count_inserted
+    AFTER INSERT ON notification REFERENCING NEW TABLE AS inserted_notifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_inserted_notifications();
+CREATE TRIGGER notification_count_deleted
+    AFTER DELETE ON notification REFERENCING OLD TABLE AS deleted_notifications
+    FOR EACH STATEMENT EXECUTE PROCEDURE count_deleted_notifications();
+CREATE TRIGGER notification_count_moved
+    AFTER UPDATE OF notification_category_id ON notification
+    FOR EACH ROW WHEN (OLD.notification_category_id IS DISTINCT FROM NEW.notification_category_id)
+    EXECUTE PROCEDURE count_moved_notification();
+CREATE TRIGGER notification_category_propagate_name
+    AFTER UPDATE OF name ON notification_category
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE propagate_notification_category_name();
+''')
+NOTIFICATION_TRIGGER_FUNCTIONS_DROP_DDL = DDL('''
+DROP FUNCTION IF EXISTS set_notification_category_name();
+DROP FUNCTION IF EXISTS count_inserted_notifications();
+DROP FUNCTION IF EXISTS count_deleted_notifications();
+DROP FUNCTION IF EXISTS count_moved_notification();
+DROP FUNCTION IF EXISTS propagate_notification_category_name();
+''')
+# create_all creates the notification table after the notification_category
+# table, and drop_all drops the notification_category table last
+event.listen(Notification.__table__, 'after_create',
+    NOTIFICATION_TRIGGER_FUNCTIONS_DDL.execute_if(dialect='postgresql'))
+event.listen(Notification.__table__, 'after_create',
+    NOTIFICATION_TRIGGERS_DDL.execute_if(dialect='postgresql'))
+event.listen(NotificationCategory.__table__, 'after_drop',
+    NOTIFICATION_TRIGGER_FUNCTIONS_DROP_DDL.execute_if(dialect='postgresql'))
 
 
 class NotificationCategorySchema(ma.Schema):
@@ -104,6 +504,10 @@ class NotificationCategorySchema(ma.Schema):
     # Minimum length = 3 characters
     name = fields.String(required=True, 
         validate=validate.Length(3))
+    # The number of stored notifications in the category. It includes the
+    # expired notifications that the reaper didn't delete yet, which the
+    # notifications field doesn't include
+    notification_count = fields.Integer(dump_only=True)
     url = ma.URLFor('service.notificationcategoryresource', 
         id='<id>', 
         _external=True)
@@ -120,6 +524,7 @@ class NotificationSchema(ma.Schema):
     ttl = fields.Integer()
     creation_date = fields.DateTime()
     notification_category = fields.Nested(NotificationCategorySchema, 
+        attribute='notification_category_summary', 
         only=['id', 'url', 'name'], 
         required=True)
     displayed_times = fields.Integer()
@@ -131,6 +536,9 @@ class NotificationSchema(ma.Schema):
     @pre_load
     def process_notification_category(self, data):
         notification_category = data.get('notification_category')
+        # Partial loads only validate the supplied fields
+        if self.partial and 'notification_category' not in data:
+            return data
         if notification_category:
             if isinstance(notification_category, dict):
                 notification_category_name = notification_category.get('name')
@@ -0,0 +1,78 @@
+from sqlalchemy import event
+import threading
+
+
+class PoolMetrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.reset()
+
+    def reset(self):
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.overflow_checkouts = 0
+        self.invalidations = 0
+        self.max_checked_out = 0
+
+    def init_app(self, app, engine):
+        # The pool events are registered for the engine that the app uses
+        self.pool = engine.pool
+        self.reset()
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+        event.listen(engine, 'invalidate', self.on_invalidate)
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        checked_out = self.get_pool_value('checkedout')
+        pool_size = self.get_pool_value('size')
+        with self.lock:
+            self.checkouts += 1
+            # The checkouts beyond the pool size use overflow connections
+            if checked_out is not None and pool_size is not None and checked_out > pool_size:
+                self.overflow_checkouts += 1
+            if checked_out is not None:
+                self.max_checked_out = max(self.max_checked_out, checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self.lock:
+            self.checkins += 1
+
+    def on_invalidate(self, dbapi_connection, connection_record, exception):
+        # The pre-ping invalidates the stale connections before it replaces them
+        with self.lock:
+            self.invalidations += 1
+
+    def get_pool_value(self, method_name):
+        # Some pool classes (such as NullPool) don't keep these values
+        method = getattr(self.pool, method_name, None)
+        if method is None:
+            return None
+        return method()
+
+    def get_stats(self):
+        with self.lock:
+            stats = {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'overflow_checkouts': self.overflow_checkouts,
+                'invalidations': self.invalidations,
+                'max_checked_out': self.max_checked_out
+            }
+        stats.update({
+            'size': self.get_pool_value('size'),
+            'checked_in': self.get_pool_value('checkedin'),
+            'checked_out': self.get_pool_value('checkedout'),
+            'overflow': self.get_pool_value('overflow')
+        })
+        return stats
+
+
+pool_metrics = PoolMetrics()
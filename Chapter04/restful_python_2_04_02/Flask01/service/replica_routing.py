@@ -0,0 +1,105 @@
+from flask import current_app, request, has_request_context, _request_ctx_stack
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.sql.dml import UpdateBase
+import itertools
+import threading
+import time
+
+
+# The requests with these methods don't modify the resources
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaRouter():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        # The last measured lag for each replica bind key: (lag, measurement time)
+        self.lags = {}
+
+    def get_lag(self, db, bind_key):
+        # Returns the replication lag in seconds for the replica, measured
+        # at most once every SQLALCHEMY_REPLICA_LAG_CHECK_INTERVAL seconds
+        check_interval = current_app.config['SQLALCHEMY_REPLICA_LAG_CHECK_INTERVAL']
+        with self.lock:
+            lag_entry = self.lags.get(bind_key)
+        if lag_entry is not None and lag_entry[1] + check_interval > time.monotonic():
+            return lag_entry[0]
+        engine = db.get_engine(current_app, bind=bind_key)
+        try:
+            if engine.dialect.name == 'postgresql':
+                # A standby that replayed all the received WAL is caught up, even if the
+                # last replayed transaction is old because the primary is idle.
+                # The functions return NULL when the server isn't a standby
+                lag = engine.scalar(
+                    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+                    'ELSE EXTRACT(EPOCH FROM (now() - pg_last_xact_replay_timestamp())) END') or 0
+            else:
+                lag = 0
+        except SQLAlchemyError:
+            # An unreachable replica is unavailable until the next check
+            current_app.logger.warning(
+                'Unable to measure the lag for the replica %s', bind_key, exc_info=True)
+            lag = float('inf')
+        with self.lock:
+            self.lags[bind_key] = (float(lag), time.monotonic())
+        return float(lag)
+
+    def get_checked_out_connections(self, db, bind_key):
+        pool = db.get_engine(current_app, bind=bind_key).pool
+        checkedout = getattr(pool, 'checkedout', None)
+        return checkedout() if checkedout is not None else 0
+
+    def select_replica(self, db):
+        # Returns the bind key for an available replica or None to use the primary
+        replica_bind_keys = current_app.config['SQLALCHEMY_REPLICA_BINDS']
+        max_lag = current_app.config['SQLALCHEMY_REPLICA_MAX_LAG']
+        available_bind_keys = [
+            bind_key for bind_key in replica_bind_keys
+            if self.get_lag(db, bind_key) <= max_lag]
+        if not available_bind_keys:
+            return None
+        if current_app.config['SQLALCHEMY_REPLICA_SELECTION'] == 'least_connections':
+            return min(
+                available_bind_keys,
+                key=lambda bind_key: self.get_checked_out_connections(db, bind_key))
+        return available_bind_keys[next(self.counter) % len(available_bind_keys)]
+
+    def require_primary(self):
+        # The rest of the request reads from the primary
+        if has_request_context():
+            _request_ctx_stack.top.primary_required = True
+
+    def get_bind_key(self, session, clause):
+        # Returns the replica bind key for the statement or None to use the primary.
+        # The routing state belongs to the request context, so a request that
+        # writes keeps using the primary for the rest of the request
+        if not has_request_context() or not current_app.config['SQLALCHEMY_REPLICA_BINDS']:
+            return None
+        request_context = _request_ctx_stack.top
+        if session._flushing or isinstance(clause, UpdateBase):
+            request_context.primary_required = True
+        if getattr(request_context, 'primary_required', False) or \
+                request.method not in SAFE_METHODS:
+            return None
+        if not hasattr(request_context, 'replica_bind_key'):
+            # All the statements for the request use the same replica
+            request_context.replica_bind_key = self.select_replica(session.db)
+        return request_context.replica_bind_key
+
+
+replica_router = ReplicaRouter()
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if mapper is None or mapper.mapped_table.info.get('bind_key') is None:
+            bind_key = replica_router.get_bind_key(self, clause)
+            if bind_key is not None:
+                return self.db.get_engine(self.app, bind=bind_key)
+        return super().get_bind(mapper, clause)
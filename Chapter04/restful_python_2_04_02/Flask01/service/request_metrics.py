@@ -0,0 +1,160 @@
+from flask import request, has_request_context, _request_ctx_stack
+from functools import wraps
+from sqlalchemy import event
+from collections import defaultdict
+import random
+import threading
+import time
+
+
+# Upper bounds (in seconds) for the request duration histogram buckets
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SampledRequest():
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phase_durations = defaultdict(float)
+        self.sql_statements = 0
+        self.sql_duration = 0.0
+
+
+class RequestMetrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sample_rate = 0
+        self.reset()
+
+    def reset(self):
+        # The aggregates for each (endpoint, method, status)
+        self.requests = defaultdict(lambda: {
+            'count': 0,
+            'duration': 0.0,
+            'buckets': [0] * len(REQUEST_DURATION_BUCKETS),
+            'sql_statements': 0,
+            'sql_duration': 0.0,
+            'phase_durations': defaultdict(float)})
+
+    def init_app(self, app, engine):
+        # The requests are only instrumented when REQUEST_METRICS_ENABLED is True,
+        # and then only the REQUEST_METRICS_SAMPLE_RATE fraction of them
+        self.reset()
+        if not app.config['REQUEST_METRICS_ENABLED']:
+            self.sample_rate = 0
+            return
+        self.sample_rate = app.config['REQUEST_METRICS_SAMPLE_RATE']
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def get_sampled_request(self):
+        # The sampled request belongs to the request context
+        if not has_request_context():
+            return None
+        return getattr(_request_ctx_stack.top, 'sampled_request', None)
+
+    def before_request(self):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            _request_ctx_stack.top.sampled_request = SampledRequest()
+
+    def after_request(self, response):
+        sampled_request = self.get_sampled_request()
+        if sampled_request is None:
+            return response
+        duration = time.perf_counter() - sampled_request.start_time
+        key = (request.endpoint, request.method, response.status_code)
+        with self.lock:
+            aggregates = self.requests[key]
+            aggregates['count'] += 1
+            aggregates['duration'] += duration
+            for index, upper_bound in enumerate(REQUEST_DURATION_BUCKETS):
+                if duration <= upper_bound:
+                    aggregates['buckets'][index] += 1
+            aggregates['sql_statements'] += sampled_request.sql_statements
+            aggregates['sql_duration'] += sampled_request.sql_duration
+            for phase, phase_duration in sampled_request.phase_durations.items():
+                aggregates['phase_durations'][phase] += phase_duration
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if self.get_sampled_request() is not None:
+            conn.info.setdefault('request_metrics_start_times', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        sampled_request = self.get_sampled_request()
+        start_times = conn.info.get('request_metrics_start_times')
+        if sampled_request is None or not start_times:
+            return
+        sampled_request.sql_statements += 1
+        sampled_request.sql_duration += time.perf_counter() - start_times.pop()
+
+    def timed(self, phase):
+        # Records the time for the decorated function in the phase. The time
+        # spent in SQL statements is excluded, because the query phase has it
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                sampled_request = self.get_sampled_request()
+                if sampled_request is None:
+                    return f(*args, **kwargs)
+                start_time = time.perf_counter()
+                start_sql_duration = sampled_request.sql_duration
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    sql_duration = sampled_request.sql_duration - start_sql_duration
+                    sampled_request.phase_durations[phase] += \
+                        time.perf_counter() - start_time - sql_duration
+            return decorated
+        return decorator
+
+    def get_prometheus_text(self):
+        lines = []
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join(
+                    '{}="{}"'.format(label_name, escape_label_value(label_value))
+                    for label_name, label_value in labels)
+                lines.append('{}{}{{{}}} {}'.format(name, suffix, label_text, value))
+        with self.lock:
+            requests = sorted((
+                (tuple(str(value) for value in key),
+                    dict(aggregates, phase_durations=dict(aggregates['phase_durations'])))
+                for key, aggregates in self.requests.items()),
+                key=lambda request_aggregates: request_aggregates[0])
+        duration_samples = []
+        sql_statements_samples = []
+        sql_duration_samples = []
+        phase_samples = []
+        for (endpoint, method, status), aggregates in requests:
+            labels = [('endpoint', endpoint), ('method', method), ('status', status)]
+            for upper_bound, count in zip(REQUEST_DURATION_BUCKETS, aggregates['buckets']):
+                duration_samples.append(('_bucket', labels + [('le', upper_bound)], count))
+            duration_samples.append(('_bucket', labels + [('le', '+Inf')], aggregates['count']))
+            duration_samples.append(('_sum', labels, aggregates['duration']))
+            duration_samples.append(('_count', labels, aggregates['count']))
+            sql_statements_samples.append(('', labels, aggregates['sql_statements']))
+            sql_duration_samples.append(('', labels, aggregates['sql_duration']))
+            phases = dict(aggregates['phase_durations'], query=aggregates['sql_duration'])
+            for phase, phase_duration in sorted(phases.items()):
+                phase_samples.append(('', labels + [('phase', phase)], phase_duration))
+        add_metric('service_request_duration_seconds', 'histogram',
+            'Duration of the sampled requests.', duration_samples)
+        add_metric('service_request_phase_seconds_total', 'counter',
+            'Time spent in each phase (auth, query, serialize, encode) by the sampled requests.',
+            phase_samples)
+        add_metric('service_sql_statements_total', 'counter',
+            'SQL statements executed by the sampled requests.', sql_statements_samples)
+        add_metric('service_sql_duration_seconds_total', 'counter',
+            'Time spent in SQL statements by the sampled requests.', sql_duration_samples)
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
@@ -0,0 +1,162 @@
+from flask import request, g
+from functools import wraps
+from collections import OrderedDict
+from replica_routing import replica_router
+import hashlib
+import json
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LocalResponseCacheBackend():
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.generations = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expiration_time = entry
+            if expiration_time <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        # Returns the number of evicted entries
+        evictions = 0
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                evictions += 1
+        return evictions
+
+    def get_generations(self, names):
+        with self.lock:
+            return [self.generations.get(name, 0) for name in names]
+
+    def increment_generation(self, name):
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+
+
+class RedisResponseCacheBackend():
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError('The redis package is required to use the redis response cache backend')
+        self.client = redis.StrictRedis.from_url(url)
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None:
+            return None
+        return json.loads(value.decode('utf-8'))
+
+    def set(self, key, value, ttl):
+        # Redis evicts the entries based on its own maxmemory policy
+        self.client.set(key, json.dumps(value), ex=ttl)
+        return 0
+
+    def get_generations(self, names):
+        generations = self.client.mget(['generation:{}'.format(name) for name in names])
+        return [int(generation or 0) for generation in generations]
+
+    def increment_generation(self, name):
+        self.client.incr('generation:{}'.format(name))
+
+
+class ResponseCache():
+    def __init__(self):
+        self.backend = None
+        self.ttl = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        backend_name = app.config['RESPONSE_CACHE_BACKEND']
+        if backend_name == 'local':
+            self.backend = LocalResponseCacheBackend(app.config['RESPONSE_CACHE_MAX_SIZE'])
+        elif backend_name == 'redis':
+            self.backend = RedisResponseCacheBackend(app.config['RESPONSE_CACHE_REDIS_URL'])
+        elif backend_name is None:
+            self.backend = None
+        else:
+            raise ValueError('Unknown response cache backend {}'.format(backend_name))
+        self.ttl = app.config['RESPONSE_CACHE_TTL']
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def invalidate(self, *table_names):
+        # Each write increments the generation for the modified tables,
+        # so the keys for the cached responses that depend on them change
+        if self.backend is None:
+            return
+        for table_name in table_names:
+            self.backend.increment_generation(table_name)
+        with self.lock:
+            self.invalidations += 1
+
+    def get_key(self, table_names):
+        user = getattr(g, 'user', None)
+        key_values = [
+            request.endpoint,
+            request.full_path,
+            request.headers.get('Accept', ''),
+            user.id if user is not None else None,
+            self.backend.get_generations(table_names)]
+        return 'response:' + hashlib.sha1(json.dumps(key_values).encode('utf-8')).hexdigest()
+
+    def cached(self, *table_names):
+        # Caches the responses for a resource method that depend on the rows of table_names
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if self.backend is None:
+                    return f(*args, **kwargs)
+                key = self.get_key(table_names)
+                result = self.backend.get(key)
+                if result is not None:
+                    with self.lock:
+                        self.hits += 1
+                    return result
+                # A lagging replica could return rows older than the current generation,
+                # which would stay cached long after the replica catches up
+                replica_router.require_primary()
+                result = f(*args, **kwargs)
+                evictions = 0
+                # Only the successful results are cached (not the tuples with a
+                # status code or the streamed responses)
+                if isinstance(result, dict):
+                    evictions = self.backend.set(key, result, self.ttl)
+                with self.lock:
+                    self.misses += 1
+                    self.evictions += evictions
+                return result
+            return decorated
+        return decorator
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations
+            }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,89 @@
+from flask import url_for
+from marshmallow import fields
+from marshmallow.decorators import PRE_DUMP, POST_DUMP
+from marshmallow.schema import MarshalResult
+from flask_marshmallow.fields import URLFor, _tpl
+from request_metrics import request_metrics
+
+
+# Placeholder for the URL template parameters (the routes use the int converter)
+URL_PARAMETER_PLACEHOLDER = 918273645546372819
+
+
+class CompiledSerializer():
+    """
+    Serializes objects with the same output as the marshmallow schema used to compile it.
+    The compiled serializer reads the attributes without the marshmallow machinery and
+    builds each URL from a template generated once for every call to dump.
+    """
+    def __init__(self, schema):
+        for (tag_name, pass_many), processors in schema.__processors__.items():
+            if processors and tag_name in (PRE_DUMP, POST_DUMP):
+                raise ValueError('The schema cannot have pre_dump or post_dump processors')
+        self.field_serializers = [
+            self.compile_field(field_name, field)
+            for field_name, field in schema.fields.items()
+            if not field.load_only]
+
+    def compile_field(self, field_name, field):
+        key = field.dump_to or field_name
+        attribute = field.attribute or field_name
+        if isinstance(field, URLFor):
+            return key, self.compile_url_field(field)
+        if isinstance(field, fields.Nested):
+            nested_serializer = CompiledSerializer(field.schema)
+            many = field.many
+            def serialize_nested(obj, url_templates):
+                value = getattr(obj, attribute)
+                if value is None:
+                    return None
+                if many:
+                    return [nested_serializer.dump_object(nested_obj, url_templates)
+                        for nested_obj in value]
+                return nested_serializer.dump_object(value, url_templates)
+            return key, serialize_nested
+        serialize_value = field._serialize
+        def serialize_field(obj, url_templates):
+            return serialize_value(getattr(obj, attribute), attribute, obj)
+        return key, serialize_field
+
+    def compile_url_field(self, field):
+        template_parameters = {}
+        url_for_parameters = {}
+        for index, (parameter_name, parameter_value) in enumerate(field.params.items()):
+            attribute = _tpl(str(parameter_value))
+            if attribute:
+                placeholder = URL_PARAMETER_PLACEHOLDER + index
+                template_parameters[str(placeholder)] = attribute
+                url_for_parameters[parameter_name] = placeholder
+            else:
+                url_for_parameters[parameter_name] = parameter_value
+        endpoint = field.endpoint
+        def build_url_template():
+            url = url_for(endpoint, **url_for_parameters)
+            # The template arguments follow the positions of the placeholders in the URL
+            placeholders = sorted(template_parameters, key=url.index)
+            url_template = url.replace('{', '{{').replace('}', '}}')
+            for placeholder in placeholders:
+                url_template = url_template.replace(placeholder, '{}')
+            return url_template, [template_parameters[placeholder] for placeholder in placeholders]
+        def serialize_url(obj, url_templates):
+            url_template = url_templates.get(field)
+            if url_template is None:
+                url_template = url_templates[field] = build_url_template()
+            template, attributes = url_template
+            return template.format(*[getattr(obj, attribute) for attribute in attributes])
+        return serialize_url
+
+    def dump_object(self, obj, url_templates):
+        return {key: serialize(obj, url_templates) for key, serialize in self.field_serializers}
+
+    @request_metrics.timed('serialize')
+    def dump(self, obj, many=False):
+        # The URL templates are built once per call, because they depend on the request
+        url_templates = {}
+        if many:
+            data = [self.dump_object(each_obj, url_templates) for each_obj in obj]
+        else:
+            data = self.dump_object(obj, url_templates)
+        return MarshalResult(data, {})
@@ -1,8 +1,20 @@
+import asyncio
 import pytest
-from base64 import b64encode
+from datetime import datetime
+from urllib.parse import parse_qs, urlsplit
+from base64 import b64encode, urlsafe_b64encode, urlsafe_b64decode
 from flask import current_app, json, url_for
 from http_status import HttpStatus
-from models import orm, NotificationCategory, Notification, User
+from models import orm, NotificationCategory, Notification, User, display_counter_buffer
+from models import ResourceAddUpdateDelete
+from response_cache import response_cache
+from helpers import encode_json
+from replica_routing import replica_router
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import OperationalError
+from views import user_schema, user_serializer, notification_schema, notification_serializer
+from views import notification_category_schema, notification_category_serializer
 
 
 TEST_USER_NAME = 'testuser'
@@ -111,9 +123,12 @@ def test_retrieve_notification_categories_list(client):
         headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
     assert get_response.status_code == HttpStatus.ok_200.value
     get_response_data = json.loads(get_response.get_data(as_text=True))
-    assert len(get_response_data) == 2
-    assert get_response_data[0]['name'] == new_notification_category_name_1
-    assert get_response_data[1]['name'] == new_notification_category_name_2
+    assert get_response_data['count'] == 2
+    assert get_response_data['previous'] is None
+    assert get_response_data['next'] is None
+    assert len(get_response_data['results']) == 2
+    assert get_response_data['results'][0]['name'] == new_notification_category_name_1
+    assert get_response_data['results'][1]['name'] == new_notification_category_name_2
 
 
 def test_update_notification_category(client):
@@ -302,3 +317,1246 @@ def test_create_and_retrieve_user(client):
     assert get_response.status_code == HttpStatus.ok_200.value
     get_response_data = json.loads(get_response.get_data(as_text=True))
     assert get_response_data['name'] == new_user_name
+
+
+def test_retrieve_notifications_list_with_cursor(client):
+    """
+    Ensure we can retrieve the notifications list with cursor pagination
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    new_notification_messages = ['Cursor notification number {}'.format(i) for i in range(6)]
+    for new_notification_message in new_notification_messages:
+        post_response = create_notification(client, new_notification_message, 15, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+    get_first_page_url = url_for('service.notificationlistresource', cursor='', _external=True)
+    get_first_page_response = client.get(
+        get_first_page_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_first_page_response.status_code == HttpStatus.ok_200.value
+    get_first_page_response_data = json.loads(get_first_page_response.get_data(as_text=True))
+    assert get_first_page_response_data['count'] is None
+    assert get_first_page_response_data['previous'] is None
+    assert get_first_page_response_data['next'] is not None
+    assert [result['message'] for result in get_first_page_response_data['results']] == \
+        new_notification_messages[:4]
+    get_second_page_response = client.get(
+        get_first_page_response_data['next'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_second_page_response.status_code == HttpStatus.ok_200.value
+    get_second_page_response_data = json.loads(get_second_page_response.get_data(as_text=True))
+    assert get_second_page_response_data['next'] is None
+    assert get_second_page_response_data['previous'] is not None
+    assert [result['message'] for result in get_second_page_response_data['results']] == \
+        new_notification_messages[4:]
+    get_previous_page_response = client.get(
+        get_second_page_response_data['previous'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_previous_page_response.status_code == HttpStatus.ok_200.value
+    get_previous_page_response_data = json.loads(get_previous_page_response.get_data(as_text=True))
+    assert get_previous_page_response_data['previous'] is None
+    assert get_previous_page_response_data['next'] is not None
+    assert [result['message'] for result in get_previous_page_response_data['results']] == \
+        new_notification_messages[:4]
+    invalid_cursor_url = url_for('service.notificationlistresource', cursor='invalid', _external=True)
+    invalid_cursor_response = client.get(
+        invalid_cursor_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert invalid_cursor_response.status_code == HttpStatus.bad_request_400.value
+    # A cursor that decodes but has a value with the wrong type for the id column
+    next_cursor = urlsafe_b64decode(
+        parse_qs(urlsplit(get_first_page_response_data['next']).query)['cursor'][0])
+    creation_date = json.loads(next_cursor.decode('utf-8'))['k'][0]
+    for wrong_type_id in (['x'], True, '1'):
+        wrong_type_cursor = urlsafe_b64encode(json.dumps(
+            {'k': [creation_date, wrong_type_id], 'f': True}).encode('utf-8'))
+        wrong_type_cursor_url = url_for(
+            'service.notificationlistresource', cursor=wrong_type_cursor.decode('utf-8'),
+            _external=True)
+        wrong_type_cursor_response = client.get(
+            wrong_type_cursor_url,
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert wrong_type_cursor_response.status_code == HttpStatus.bad_request_400.value
+
+
+def assert_sql_statements_count(sql_statements, expected_count):
+    """
+    Ensure the request executed the expected number of SQL statements
+    """
+    assert len(sql_statements) == expected_count, '\n'.join(sql_statements)
+
+
+def test_retrieve_notifications_list_sql_statements(client, sql_statements):
+    """
+    Ensure retrieving a page of notifications doesn't run a query per notification category
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(4):
+        post_response = create_notification(client, 'Notification in category {}'.format(i), 15, 'Category {}'.format(i))
+        assert post_response.status_code == HttpStatus.created_201.value
+    url = url_for('service.notificationlistresource', _external=True)
+    del sql_statements[:]
+    get_response = client.get(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert len(get_response_data['results']) == 4
+    # The count and the page, which reads the denormalized category names without a join
+    # (the credentials were verified by the previous requests)
+    assert_sql_statements_count(sql_statements, 2)
+
+
+def test_retrieve_notification_categories_list_sql_statements(client, sql_statements):
+    """
+    Ensure retrieving the notification categories doesn't run a query per category
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(4):
+        post_response = create_notification(client, 'Notification in category {}'.format(i), 15, 'Category {}'.format(i))
+        assert post_response.status_code == HttpStatus.created_201.value
+    url = url_for('service.notificationcategorylistresource', _external=True)
+    del sql_statements[:]
+    get_response = client.get(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert len(get_response_data['results']) == 4
+    assert get_response_data['results'][0]['notifications'][0]['message'] == 'Notification in category 0'
+    # The count, the categories and the notifications for all the categories
+    # (the credentials were verified by the previous requests)
+    assert_sql_statements_count(sql_statements, 3)
+
+
+def test_stream_notification_categories_list(client):
+    """
+    Ensure we can retrieve all the notification categories as newline delimited JSON
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    new_notification_category_names = ['Streamed category {}'.format(i) for i in range(5)]
+    for new_notification_category_name in new_notification_category_names:
+        post_response = create_notification_category(client, new_notification_category_name)
+        assert post_response.status_code == HttpStatus.created_201.value
+    url = url_for('service.notificationcategorylistresource', _external=True)
+    headers = get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD)
+    headers['Accept'] = 'application/x-ndjson'
+    get_response = client.get(url, headers=headers)
+    assert get_response.status_code == HttpStatus.ok_200.value
+    assert get_response.mimetype == 'application/x-ndjson'
+    lines = get_response.get_data(as_text=True).splitlines()
+    assert [json.loads(line)['name'] for line in lines] == new_notification_category_names
+
+
+def test_verified_credentials_are_cached(client, sql_statements):
+    """
+    Ensure we don't query the user again after the credentials were verified
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    new_user_url = json.loads(create_user_response.get_data(as_text=True))['url']
+    del sql_statements[:]
+    first_get_response = client.get(
+        new_user_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert first_get_response.status_code == HttpStatus.ok_200.value
+    # The authentication query loads the user for the retrieval
+    assert_sql_statements_count(sql_statements, 1)
+    del sql_statements[:]
+    second_get_response = client.get(
+        new_user_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert second_get_response.status_code == HttpStatus.ok_200.value
+    assert json.loads(second_get_response.get_data(as_text=True))['name'] == TEST_USER_NAME
+    # The cached credentials provide the user
+    assert_sql_statements_count(sql_statements, 0)
+    wrong_password_get_response = client.get(
+        new_user_url,
+        headers=get_authentication_headers(TEST_USER_NAME, 'wrongpassword'))
+    assert wrong_password_get_response.status_code == HttpStatus.unauthorized_401.value
+
+
+def test_retrieve_notifications_list_with_token(client):
+    """
+    Ensure we can access a resource with a Bearer token instead of the Basic authentication
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    token_response = client.get(
+        url_for('service.tokenresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert token_response.status_code == HttpStatus.ok_200.value
+    token = json.loads(token_response.get_data(as_text=True))['token']
+    url = url_for('service.notificationlistresource', _external=True)
+    headers = get_accept_content_type_headers()
+    headers['Authorization'] = 'Bearer ' + token
+    get_response = client.get(url, headers=headers)
+    assert get_response.status_code == HttpStatus.ok_200.value
+    headers['Authorization'] = 'Bearer ' + token + 'invalid'
+    invalid_token_get_response = client.get(url, headers=headers)
+    assert invalid_token_get_response.status_code == HttpStatus.unauthorized_401.value
+
+
+def test_bulk_create_notifications(client):
+    """
+    Ensure we can create many notifications with a single request and retrieve the errors per item
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Existing notification', 15, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    url = url_for('service.notificationbulkresource', _external=True)
+    data = [
+        {'message': 'First bulk notification', 'ttl': 10, 'notification_category': 'Information'},
+        {'message': 'Second bulk notification', 'ttl': 20, 'notification_category': 'Warning'},
+        {'message': 'Existing notification', 'ttl': 30, 'notification_category': 'Information'},
+        {'message': 'First bulk notification', 'ttl': 40, 'notification_category': 'Error'},
+        {'message': 'Bad', 'ttl': 50, 'notification_category': 'Error'},
+    ]
+    bulk_post_response = client.post(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps(data))
+    assert bulk_post_response.status_code == HttpStatus.created_201.value
+    bulk_post_response_data = json.loads(bulk_post_response.get_data(as_text=True))
+    assert [result['message'] for result in bulk_post_response_data['results']] == \
+        ['First bulk notification', 'Second bulk notification']
+    assert bulk_post_response_data['results'][1]['notification_category']['name'] == 'Warning'
+    assert sorted(bulk_post_response_data['errors'].keys()) == ['2', '3', '4']
+    assert Notification.query.count() == 3
+    assert NotificationCategory.query.count() == 2
+
+
+def test_bulk_create_existing_notifications(client):
+    """
+    Ensure the bulk create reports the existing messages as errors per item without creating categories
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Existing notification', 15, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    bulk_post_response = client.post(
+        url_for('service.notificationbulkresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps([
+            {'message': 'Existing notification', 'ttl': 30, 'notification_category': 'Warning'}]))
+    assert bulk_post_response.status_code == HttpStatus.bad_request_400.value
+    bulk_post_response_data = json.loads(bulk_post_response.get_data(as_text=True))
+    assert bulk_post_response_data['results'] == []
+    assert bulk_post_response_data['errors'] == {
+        '0': {'error': 'A notification with the message Existing notification already exists'}}
+    assert NotificationCategory.query.count() == 1
+
+
+def test_create_notification_category_sql_statements(client, sql_statements):
+    """
+    Ensure we don't read a notification category again after we create it
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response_1 = create_notification_category(client, 'Information')
+    assert post_response_1.status_code == HttpStatus.created_201.value
+    del sql_statements[:]
+    post_response_2 = create_notification_category(client, 'Warning')
+    assert post_response_2.status_code == HttpStatus.created_201.value
+    assert json.loads(post_response_2.get_data(as_text=True))['name'] == 'Warning'
+    # The unique constraint replaces the uniqueness check, so the insert is the only statement
+    assert_sql_statements_count(sql_statements, 1)
+
+
+def test_create_notification_sql_statements(client, sql_statements):
+    """
+    Ensure the insert retrieves the server defaults for a new notification
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response_1 = create_notification(client, 'First notification', 15, 'Information')
+    assert post_response_1.status_code == HttpStatus.created_201.value
+    del sql_statements[:]
+    post_response_2 = create_notification(client, 'Second notification', 15, 'Information')
+    assert post_response_2.status_code == HttpStatus.created_201.value
+    post_response_data_2 = json.loads(post_response_2.get_data(as_text=True))
+    assert post_response_data_2['displayed_times'] == 0
+    assert post_response_data_2['displayed_once'] is False
+    assert post_response_data_2['creation_date'] is not None
+    # The category and the insert
+    assert_sql_statements_count(sql_statements, 2)
+
+
+def test_update_notification_category_with_duplicated_name(client):
+    """
+    Ensure we cannot rename a notification category with the name of another category
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response_1 = create_notification_category(client, 'Information')
+    assert post_response_1.status_code == HttpStatus.created_201.value
+    post_response_2 = create_notification_category(client, 'Warning')
+    assert post_response_2.status_code == HttpStatus.created_201.value
+    post_response_data_2 = json.loads(post_response_2.get_data(as_text=True))
+    patch_response = client.patch(
+        post_response_data_2['url'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'name': 'Information'}))
+    assert patch_response.status_code == HttpStatus.bad_request_400.value
+    patch_response_data = json.loads(patch_response.get_data(as_text=True))
+    assert patch_response_data['error'] == 'A category with the name Information already exists'
+    get_response = client.get(
+        post_response_data_2['url'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert json.loads(get_response.get_data(as_text=True))['name'] == 'Warning'
+
+
+def test_increment_notification_displayed_times(client):
+    """
+    Ensure we can increment the displayed times for an existing notification
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    post_response_data = json.loads(post_response.get_data(as_text=True))
+    url = url_for('service.notificationdisplayresource', id=post_response_data['id'], _external=True)
+    first_post_response = client.post(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert first_post_response.status_code == HttpStatus.ok_200.value
+    second_post_response = client.post(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'times': 3}))
+    assert second_post_response.status_code == HttpStatus.ok_200.value
+    second_post_response_data = json.loads(second_post_response.get_data(as_text=True))
+    assert second_post_response_data['displayed_times'] == 4
+    assert second_post_response_data['displayed_once'] is True
+    missing_notification_url = url_for('service.notificationdisplayresource', id=0, _external=True)
+    missing_notification_post_response = client.post(
+        missing_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert missing_notification_post_response.status_code == HttpStatus.not_found_404.value
+
+
+def test_buffer_notification_displayed_times(application, client):
+    """
+    Ensure the write-behind buffer coalesces the increments for the displayed times
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    post_response_data = json.loads(post_response.get_data(as_text=True))
+    url = url_for('service.notificationdisplayresource', id=post_response_data['id'], _external=True)
+    application.config['DISPLAY_COUNTER_BUFFER_ENABLED'] = True
+    for i in range(3):
+        post_response = client.post(
+            url,
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+            data=json.dumps({'times': 2}))
+        assert post_response.status_code == HttpStatus.accepted_202.value
+    too_many_times_post_response = client.post(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'times': application.config['DISPLAY_COUNTER_MAX_TIMES'] + 1}))
+    assert too_many_times_post_response.status_code == HttpStatus.bad_request_400.value
+    assert display_counter_buffer.flush() == 1
+    orm.session.expire_all()
+    notification = Notification.query.get(post_response_data['id'])
+    assert notification.displayed_times == 6
+    assert notification.displayed_once is True
+
+
+def test_failed_buffer_flush_keeps_the_increments(application, client, monkeypatch):
+    """
+    Ensure a failed flush puts the increments back in the write-behind buffer
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    notification_id = json.loads(post_response.get_data(as_text=True))['id']
+    display_counter_buffer.add(notification_id, 2)
+    def execute(*args, **kwargs):
+        raise OperationalError('UPDATE', {}, Exception('The database is not available'))
+    with monkeypatch.context() as patch:
+        patch.setattr(orm.session, 'execute', execute)
+        with pytest.raises(OperationalError):
+            display_counter_buffer.flush()
+    display_counter_buffer.add(notification_id, 3)
+    assert display_counter_buffer.flush() == 1
+    orm.session.expire_all()
+    assert Notification.query.get(notification_id).displayed_times == 5
+
+
+def test_invalid_buffer_flush_drops_the_increments(application, client):
+    """
+    Ensure a buffer flush that can never succeed drops the increments instead of retrying them
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    notification_id = json.loads(post_response.get_data(as_text=True))['id']
+    # The coalesced increments are out of the integer range
+    display_counter_buffer.add(notification_id, 2 ** 31)
+    assert display_counter_buffer.flush() == 0
+    assert display_counter_buffer.pending_increments == {}
+    display_counter_buffer.add(notification_id, 3)
+    assert display_counter_buffer.flush() == 1
+    orm.session.expire_all()
+    assert Notification.query.get(notification_id).displayed_times == 3
+
+
+def test_expired_notifications(application, client):
+    """
+    Ensure expired notifications are not retrieved and the reaper deletes them
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(3):
+        post_response = create_notification(client, 'Expired notification {}'.format(i), 0, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+    expired_notification_url = json.loads(post_response.get_data(as_text=True))['url']
+    post_response = create_notification(client, 'Active notification', 3600, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    get_response = client.get(
+        url_for('service.notificationlistresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert get_response_data['count'] == 1
+    assert get_response_data['results'][0]['message'] == 'Active notification'
+    get_expired_response = client.get(
+        expired_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_expired_response.status_code == HttpStatus.not_found_404.value
+    # The expired notifications can't be updated or deleted either
+    patch_expired_response = client.patch(
+        expired_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'displayed_once': True}))
+    assert patch_expired_response.status_code == HttpStatus.not_found_404.value
+    delete_expired_response = client.delete(
+        expired_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert delete_expired_response.status_code == HttpStatus.not_found_404.value
+    expired_notification = Notification.query.filter_by(message='Expired notification 2').one()
+    display_expired_response = client.post(
+        url_for('service.notificationdisplayresource', id=expired_notification.id, _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert display_expired_response.status_code == HttpStatus.not_found_404.value
+    # The category representations only include the unexpired notifications
+    notification_category = NotificationCategory.query.filter_by(name='Information').one()
+    get_category_response = client.get(
+        url_for('service.notificationcategoryresource', id=notification_category.id, _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_category_response.status_code == HttpStatus.ok_200.value
+    assert [notification['message'] for notification in json.loads(
+        get_category_response.get_data(as_text=True))['notifications']] == ['Active notification']
+    get_categories_response = client.get(
+        url_for('service.notificationcategorylistresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_categories_response.status_code == HttpStatus.ok_200.value
+    assert [notification['message'] for notification in json.loads(
+        get_categories_response.get_data(as_text=True))['results'][0]['notifications']] == \
+        ['Active notification']
+    runner = application.test_cli_runner()
+    invalid_reap_result = runner.invoke(args=['notifications', 'reap', '--batch-size', '0'])
+    assert invalid_reap_result.exit_code == 2
+    reap_result = runner.invoke(args=['notifications', 'reap'])
+    assert reap_result.exit_code == 0
+    assert 'Deleted 3 expired notifications' in reap_result.output
+    assert Notification.query.count() == 1
+
+
+def test_conditional_get_notification(client):
+    """
+    Ensure we retrieve a 304 status code for an unchanged notification with a matching ETag
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    new_notification_url = json.loads(post_response.get_data(as_text=True))['url']
+    get_response = client.get(
+        new_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    etag = get_response.headers['ETag']
+    headers = get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD)
+    headers['If-None-Match'] = etag
+    not_modified_get_response = client.get(new_notification_url, headers=headers)
+    assert not_modified_get_response.status_code == HttpStatus.not_modified_304.value
+    assert not_modified_get_response.headers['ETag'] == etag
+    patch_response = client.patch(
+        new_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'displayed_times': 1}))
+    assert patch_response.status_code == HttpStatus.ok_200.value
+    modified_get_response = client.get(new_notification_url, headers=headers)
+    assert modified_get_response.status_code == HttpStatus.ok_200.value
+    assert modified_get_response.headers['ETag'] != etag
+
+
+def test_conditional_get_notification_category(client):
+    """
+    Ensure the ETag for a notification category changes when its notifications change
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    post_response_data = json.loads(post_response.get_data(as_text=True))
+    notification_category_url = url_for('service.notificationcategoryresource',
+        id=post_response_data['notification_category']['id'], _external=True)
+    get_response = client.get(
+        notification_category_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    headers = get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD)
+    headers['If-None-Match'] = get_response.headers['ETag']
+    not_modified_get_response = client.get(notification_category_url, headers=headers)
+    assert not_modified_get_response.status_code == HttpStatus.not_modified_304.value
+    post_response = create_notification(client, 'Fortnite has a new 2nd position', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    modified_get_response = client.get(notification_category_url, headers=headers)
+    assert modified_get_response.status_code == HttpStatus.ok_200.value
+    assert len(json.loads(modified_get_response.get_data(as_text=True))['notifications']) == 2
+    # The reaper deletes an expired notification, which only changes the notifications count
+    post_response = create_notification(client, 'Fortnite has an expired position', 0, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    get_response = client.get(
+        notification_category_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert json.loads(get_response.get_data(as_text=True))['notification_count'] == 3
+    headers['If-None-Match'] = get_response.headers['ETag']
+    assert Notification.delete_expired(100) == 1
+    orm.session.expire_all()
+    reaped_get_response = client.get(notification_category_url, headers=headers)
+    assert reaped_get_response.status_code == HttpStatus.ok_200.value
+    assert json.loads(reaped_get_response.get_data(as_text=True))['notification_count'] == 2
+
+
+def test_retrieve_notifications_list_from_response_cache(client, sql_statements):
+    """
+    Ensure the response cache serves repeated list requests and a write invalidates it
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    url = url_for('service.notificationlistresource', _external=True)
+    first_get_response = client.get(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert first_get_response.status_code == HttpStatus.ok_200.value
+    del sql_statements[:]
+    second_get_response = client.get(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert second_get_response.status_code == HttpStatus.ok_200.value
+    assert second_get_response.get_data() == first_get_response.get_data()
+    assert_sql_statements_count(sql_statements, 0)
+    post_response = create_notification(client, 'Fortnite has a new 2nd position', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    third_get_response = client.get(
+        url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert json.loads(third_get_response.get_data(as_text=True))['count'] == 2
+    stats = response_cache.get_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+
+
+def test_update_notification_message_and_ttl(client, sql_statements):
+    """
+    Ensure we can update the message and the ttl for an existing notification
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    new_notification_url = json.loads(post_response.get_data(as_text=True))['url']
+    # Keeping the same message is not a duplicate
+    data = {'message': 'Fortnite has a new winner', 'ttl': 60}
+    del sql_statements[:]
+    patch_response = client.patch(
+        new_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps(data))
+    assert patch_response.status_code == HttpStatus.ok_200.value
+    patch_response_data = json.loads(patch_response.get_data(as_text=True))
+    assert patch_response_data['message'] == 'Fortnite has a new winner'
+    assert patch_response_data['ttl'] == 60
+    update_statements = [statement for statement in sql_statements if statement.startswith('UPDATE')]
+    assert len(update_statements) == 1
+    assert 'message' not in update_statements[0]
+    invalid_patch_response = client.patch(
+        new_notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'ttl': 'invalid'}))
+    assert invalid_patch_response.status_code == HttpStatus.bad_request_400.value
+
+
+def test_update_notification_after_display_increment(client):
+    """
+    Ensure a display counter increment doesn't make a concurrent update fail and both change the version
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    notification_id = json.loads(post_response.get_data(as_text=True))['id']
+    # The PATCH request loaded the notification before the increment
+    notification = Notification.query.get(notification_id)
+    assert notification.version == 1
+    Notification.increment_displayed_times(notification_id, 1)
+    notification.ttl = 60
+    notification.update()
+    orm.session.expire_all()
+    notification = Notification.query.get(notification_id)
+    assert notification.ttl == 60
+    assert notification.displayed_times == 1
+    assert notification.version == 3
+
+
+def test_compiled_serializers_match_schemas(client):
+    """
+    Ensure the compiled serializers generate the same output as the marshmallow schemas
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    create_notification(client, 'Uncharted 4 has a new 2nd winner', 15, 'Information')
+    users = User.query.all()
+    notifications = Notification.query.order_by(Notification.id).all()
+    notification_categories = NotificationCategory.query.all()
+    assert user_serializer.dump(users, many=True).data == \
+        user_schema.dump(users, many=True).data
+    assert notification_serializer.dump(notifications, many=True).data == \
+        notification_schema.dump(notifications, many=True).data
+    assert notification_serializer.dump(notifications[0]).data == \
+        notification_schema.dump(notifications[0]).data
+    assert notification_category_serializer.dump(notification_categories, many=True).data == \
+        notification_category_schema.dump(notification_categories, many=True).data
+
+
+def test_json_encoders_generate_the_same_response(application, client):
+    """
+    Ensure the configured JSON encoders generate the same notifications list
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    url = url_for('service.notificationlistresource', _external=True)
+    responses_data = []
+    for json_encoder in ('orjson', 'json'):
+        application.config['JSON_ENCODER'] = json_encoder
+        response_cache.invalidate('notification')
+        get_response = client.get(
+            url,
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        assert get_response.get_data(as_text=True).endswith('\n')
+        responses_data.append(json.loads(get_response.get_data(as_text=True)))
+    assert responses_data[0] == responses_data[1]
+    assert encode_json({'date': datetime(2018, 10, 1, 12, 30)}) == \
+        b'{"date": "2018-10-01T12:30:00"}\n'
+
+
+def test_retrieve_pool_metrics(application, client):
+    """
+    Ensure the engine uses the configured pool options and we can retrieve the pool metrics
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    assert orm.engine.pool._pre_ping
+    get_response = client.get(
+        url_for('service.poolmetricsresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert get_response_data['size'] == application.config['SQLALCHEMY_POOL_SIZE']
+    assert get_response_data['checkouts'] >= 1
+    assert get_response_data['connects'] >= 1
+    assert get_response_data['overflow_checkouts'] == 0
+
+
+def test_route_safe_requests_to_replicas(application, client, sql_statements):
+    """
+    Ensure the GET requests read from an available replica and the other requests use the primary
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    # The replica bind uses a second engine connected to the test database
+    application.config['SQLALCHEMY_BINDS'] = {'replica': application.config['SQLALCHEMY_DATABASE_URI']}
+    application.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica']
+    application.config['RESPONSE_CACHE_BACKEND'] = None
+    replica_sql_statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        replica_sql_statements.append(statement)
+    replica_engine = orm.get_engine(application, bind='replica')
+    event.listen(replica_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        del sql_statements[:]
+        post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+        assert len(replica_sql_statements) == 0
+        assert len(sql_statements) > 0
+        del sql_statements[:]
+        get_response = client.get(
+            json.loads(post_response.get_data(as_text=True))['url'],
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        assert len(replica_sql_statements) > 0
+        assert_sql_statements_count(sql_statements, 0)
+        # A replica with a lag greater than the maximum lag is skipped
+        application.config['SQLALCHEMY_REPLICA_MAX_LAG'] = -1
+        replica_router.lags.clear()
+        del replica_sql_statements[:]
+        get_response = client.get(
+            json.loads(post_response.get_data(as_text=True))['url'],
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        assert all(statement.startswith('SELECT CASE') for statement in replica_sql_statements)
+        assert len(sql_statements) > 0
+    finally:
+        event.remove(replica_engine, 'before_cursor_execute', before_cursor_execute)
+        orm.session.commit()
+
+
+def test_cached_responses_read_from_the_primary(application, client, sql_statements):
+    """
+    Ensure the cache misses read from the primary, so the cached responses never come from a lagging replica
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    application.config['SQLALCHEMY_BINDS'] = {'replica': application.config['SQLALCHEMY_DATABASE_URI']}
+    application.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica']
+    replica_sql_statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        replica_sql_statements.append(statement)
+    replica_engine = orm.get_engine(application, bind='replica')
+    event.listen(replica_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        del sql_statements[:]
+        get_response = client.get(
+            url_for('service.notificationlistresource', _external=True),
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        assert not any('FROM notification' in statement for statement in replica_sql_statements)
+        assert any('FROM notification' in statement for statement in sql_statements)
+    finally:
+        event.remove(replica_engine, 'before_cursor_execute', before_cursor_execute)
+        orm.session.commit()
+
+
+def test_unreachable_replica_uses_the_primary(application, client, sql_statements):
+    """
+    Ensure the GET requests read from the primary when the lag check for the replica fails
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    # The test database on a port where nothing listens, so the connections to the replica are refused
+    replica_url = make_url(application.config['SQLALCHEMY_DATABASE_URI'])
+    replica_url.port = 1
+    application.config['SQLALCHEMY_BINDS'] = {'replica': str(replica_url)}
+    application.config['SQLALCHEMY_REPLICA_BINDS'] = ['replica']
+    application.config['RESPONSE_CACHE_BACKEND'] = None
+    replica_router.lags.clear()
+    try:
+        del sql_statements[:]
+        get_response = client.get(
+            json.loads(post_response.get_data(as_text=True))['url'],
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        assert len(sql_statements) > 0
+        assert replica_router.lags['replica'][0] == float('inf')
+    finally:
+        # drop_all runs for all the binds when the test ends
+        application.config['SQLALCHEMY_BINDS'] = {}
+        application.config['SQLALCHEMY_REPLICA_BINDS'] = []
+
+
+def test_after_commit_handlers(client):
+    """
+    Ensure the after commit handlers receive the changes for the resources
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    changes = []
+    @ResourceAddUpdateDelete.on_after_commit
+    def append_change(operation, table_name, resource):
+        changes.append((operation, table_name))
+    try:
+        post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+        assert changes == [('add', 'notification')]
+        patch_response = client.patch(
+            json.loads(post_response.get_data(as_text=True))['url'],
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+            data=json.dumps({'displayed_once': True}))
+        assert patch_response.status_code == HttpStatus.ok_200.value
+        assert changes[-1] == ('update', 'notification')
+    finally:
+        ResourceAddUpdateDelete.after_commit_handlers.remove(append_change)
+
+
+def test_failed_after_commit_handler(client):
+    """
+    Ensure a failed after commit handler doesn't fail the committed write or the other handlers
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    changes = []
+    def fail(operation, table_name, resource):
+        raise ConnectionError('The cache is not available')
+    def append_change(operation, table_name, resource):
+        changes.append((operation, table_name))
+    ResourceAddUpdateDelete.after_commit_handlers[:0] = [fail, append_change]
+    try:
+        post_response = create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+        assert changes == [('add', 'notification')]
+    finally:
+        ResourceAddUpdateDelete.after_commit_handlers.remove(fail)
+        ResourceAddUpdateDelete.after_commit_handlers.remove(append_change)
+
+
+def get_query_plan(query):
+    # The test tables are small, so disable the sequential scans and the
+    # sorts to check the plans that the indexes make possible
+    orm.session.execute('SET LOCAL enable_seqscan = off')
+    orm.session.execute('SET LOCAL enable_sort = off')
+    statement = query.statement.compile(
+        dialect=orm.engine.dialect,
+        compile_kwargs={'literal_binds': True})
+    rows = orm.session.execute('EXPLAIN {}'.format(statement)).fetchall()
+    orm.session.rollback()
+    return '\n'.join(row[0] for row in rows)
+
+
+def test_notification_queries_use_indexes(client):
+    """
+    Ensure the notifications list pagination and the notifications backref use the indexes
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    create_notification(client, 'Fortnite has a new winner', 30, 'Information')
+    create_notification(client, 'Uncharted 4 has a new 2nd winner', 15, 'Information')
+    page_query = Notification.get_unexpired_query().order_by(
+        Notification.creation_date, Notification.id).limit(5)
+    assert 'ix_notification_creation_date_id' in get_query_plan(page_query)
+    notification_category = NotificationCategory.query.first()
+    backref_query = Notification.query.filter(
+        Notification.notification_category_id == notification_category.id).order_by(
+        Notification.message)
+    assert 'ix_notification_notification_category_id_message' in get_query_plan(backref_query)
+
+
+def test_notifications_list_pages_have_deterministic_order(client):
+    """
+    Ensure the notifications list pages follow the creation date and id order
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    messages = ['Notification number {}'.format(i) for i in range(6)]
+    for message in messages:
+        post_response = create_notification(client, message, 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+    # Updating a notification must not change its position
+    first_notification = Notification.query.filter_by(message=messages[0]).one()
+    first_notification.displayed_times = 1
+    first_notification.update()
+    retrieved_messages = []
+    for page in (1, 2):
+        get_response = client.get(
+            url_for('service.notificationlistresource', page=page, _external=True),
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        retrieved_messages.extend(
+            notification['message'] for notification in json.loads(get_response.get_data(as_text=True))['results'])
+    assert retrieved_messages == messages
+
+
+def get_notifications_list_messages(client, **arguments):
+    get_response = client.get(
+        url_for('service.notificationlistresource', _external=True, **arguments),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    return [notification['message'] for notification in get_response_data['results']], get_response_data
+
+
+def test_filter_and_order_notifications_list(client):
+    """
+    Ensure we can filter and order the notifications list with the query arguments
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(5):
+        create_notification(client, 'Information number {}'.format(i), 30, 'Information')
+    create_notification(client, 'Warning number 0', 3600, 'Warning')
+    post_response = create_notification(client, 'Warning number 1', 3600, 'Warning')
+    patch_response = client.patch(
+        json.loads(post_response.get_data(as_text=True))['url'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'displayed_once': True}))
+    assert patch_response.status_code == HttpStatus.ok_200.value
+    messages, _ = get_notifications_list_messages(client, notification_category='Warning')
+    assert messages == ['Warning number 0', 'Warning number 1']
+    messages, _ = get_notifications_list_messages(client, displayed_once='true')
+    assert messages == ['Warning number 1']
+    messages, _ = get_notifications_list_messages(client, ttl_remaining_min=60)
+    assert messages == ['Warning number 0', 'Warning number 1']
+    messages, _ = get_notifications_list_messages(client, creation_date_from='2100-01-01T00:00:00')
+    assert messages == []
+    # The URLs for the other pages keep the filter and the ordering
+    messages, get_response_data = get_notifications_list_messages(
+        client, notification_category='Information', ordering='-message')
+    assert messages == ['Information number {}'.format(i) for i in (4, 3, 2, 1)]
+    assert 'notification_category=Information' in get_response_data['next']
+    assert 'ordering=-message' in get_response_data['next']
+    next_page_response = client.get(
+        get_response_data['next'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    next_page_messages = [notification['message']
+        for notification in json.loads(next_page_response.get_data(as_text=True))['results']]
+    assert next_page_messages == ['Information number 0']
+    messages, get_response_data = get_notifications_list_messages(
+        client, notification_category='Information', ordering='-message', cursor='')
+    assert messages == ['Information number {}'.format(i) for i in (4, 3, 2, 1)]
+    next_page_response = client.get(
+        get_response_data['next'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    next_page_response_data = json.loads(next_page_response.get_data(as_text=True))
+    assert [notification['message'] for notification in next_page_response_data['results']] == \
+        ['Information number 0']
+    previous_page_response = client.get(
+        next_page_response_data['previous'],
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    previous_page_messages = [notification['message']
+        for notification in json.loads(previous_page_response.get_data(as_text=True))['results']]
+    assert previous_page_messages == ['Information number {}'.format(i) for i in (4, 3, 2, 1)]
+    invalid_ordering_response = client.get(
+        url_for('service.notificationlistresource', ordering='ttl', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert invalid_ordering_response.status_code == HttpStatus.bad_request_400.value
+    invalid_filter_response = client.get(
+        url_for('service.notificationlistresource', displayed_once='maybe', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert invalid_filter_response.status_code == HttpStatus.bad_request_400.value
+    for ttl_remaining_min in ('99999999999999', '2147483648'):
+        out_of_range_filter_response = client.get(
+            url_for('service.notificationlistresource', ttl_remaining_min=ttl_remaining_min,
+                _external=True),
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert out_of_range_filter_response.status_code == HttpStatus.bad_request_400.value
+
+
+def test_retrieve_notifications_with_sparse_fieldsets(client, sql_statements):
+    """
+    Ensure the fields argument narrows the notification representations and the SELECT statements
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(5):
+        post_response = create_notification(client, 'Information number {}'.format(i), 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+    orm.session.expunge_all()
+    del sql_statements[:]
+    for arguments in ({'fields': 'id,message,ttl'}, {'fields': 'id,message,ttl', 'cursor': ''}):
+        get_response = client.get(
+            url_for('service.notificationlistresource', _external=True, **arguments),
+            headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+        assert get_response.status_code == HttpStatus.ok_200.value
+        results = json.loads(get_response.get_data(as_text=True))['results']
+        assert len(results) == 4
+        assert all(set(result) == {'id', 'message', 'ttl'} for result in results)
+    select_statements = [statement for statement in sql_statements
+        if statement.startswith('SELECT') and 'count(*)' not in statement]
+    assert len(select_statements) == 2
+    assert all('displayed_times' not in statement for statement in select_statements)
+    assert all('notification_category' not in statement.split('FROM')[1] for statement in select_statements)
+    notification_url = json.loads(post_response.get_data(as_text=True))['url']
+    get_response = client.get(
+        notification_url + '?fields=message,notification_category',
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert set(get_response_data) == {'message', 'notification_category'}
+    assert get_response_data['notification_category']['name'] == 'Information'
+    full_get_response = client.get(
+        notification_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert full_get_response.headers['ETag'] != get_response.headers['ETag']
+    invalid_get_response = client.get(
+        notification_url + '?fields=message,password',
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert invalid_get_response.status_code == HttpStatus.bad_request_400.value
+
+
+def get_asgi_messages(asgi_app, loop, url, headers):
+    # Calls the ASGI application without a server and returns the messages it sends
+    url_parts = urlsplit(url)
+    scope = {
+        'type': 'http',
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': url_parts.scheme,
+        'root_path': '',
+        'path': url_parts.path,
+        'query_string': url_parts.query.encode('latin-1'),
+        'headers': [(b'host', url_parts.netloc.encode('latin-1'))] + [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()],
+        'server': (url_parts.hostname, 80),
+    }
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        messages.append(message)
+    loop.run_until_complete(asgi_app(scope, receive, send))
+    return messages
+
+
+def call_asgi_app(asgi_app, loop, url, headers):
+    # Calls the ASGI application without a server and returns the status and the body
+    messages = get_asgi_messages(asgi_app, loop, url, headers)
+    return messages[0]['status'], b''.join(message.get('body', b'') for message in messages[1:])
+
+
+def test_asgi_app_generates_the_same_responses(client):
+    """
+    Ensure the ASGI deployment mode generates the same responses as the WSGI application
+    """
+    pytest.importorskip('asyncpg')
+    from asgi import create_asgi_app
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    for i in range(5):
+        post_response = create_notification(client, 'Information number {}'.format(i), 30, 'Information')
+        assert post_response.status_code == HttpStatus.created_201.value
+    notification_url = json.loads(post_response.get_data(as_text=True))['url']
+    notification_category_url = json.loads(post_response.get_data(as_text=True))['notification_category']['url']
+    user_url = json.loads(create_user_response.get_data(as_text=True))['url']
+    asgi_app = create_asgi_app('test_config')
+    loop = asyncio.new_event_loop()
+    headers = get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD)
+    try:
+        for url in (
+                url_for('service.notificationlistresource', _external=True),
+                url_for('service.notificationlistresource', page=2, _external=True),
+                url_for('service.notificationlistresource', cursor='', _external=True),
+                notification_url,
+                url_for('service.notificationcategorylistresource', _external=True),
+                notification_category_url,
+                url_for('service.userlistresource', _external=True),
+                user_url):
+            get_response = client.get(url, headers=headers)
+            asgi_status, asgi_body = call_asgi_app(asgi_app, loop, url, headers)
+            assert asgi_status == get_response.status_code == HttpStatus.ok_200.value
+            assert json.loads(asgi_body.decode('utf-8')) == json.loads(get_response.get_data(as_text=True))
+        asgi_status, _ = call_asgi_app(
+            asgi_app, loop, notification_url, get_authentication_headers(TEST_USER_NAME, 'wrong'))
+        assert asgi_status == HttpStatus.unauthorized_401.value
+    finally:
+        loop.run_until_complete(asgi_app.stop())
+        loop.close()
+
+
+def test_asgi_app_streams_the_delegated_responses(client):
+    """
+    Ensure the ASGI deployment mode sends each chunk of a streamed WSGI response as it is generated
+    """
+    pytest.importorskip('asyncpg')
+    from asgi import create_asgi_app
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    new_notification_category_names = ['Streamed category {}'.format(i) for i in range(3)]
+    for new_notification_category_name in new_notification_category_names:
+        post_response = create_notification_category(client, new_notification_category_name)
+        assert post_response.status_code == HttpStatus.created_201.value
+    asgi_app = create_asgi_app('test_config')
+    loop = asyncio.new_event_loop()
+    headers = get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD)
+    headers['Accept'] = 'application/x-ndjson'
+    try:
+        messages = get_asgi_messages(
+            asgi_app, loop, url_for('service.notificationcategorylistresource', _external=True), headers)
+    finally:
+        loop.run_until_complete(asgi_app.stop())
+        loop.close()
+    assert messages[0]['status'] == HttpStatus.ok_200.value
+    body_messages = messages[1:]
+    # One message for each line and a last empty message
+    assert [json.loads(message['body'].decode('utf-8'))['name'] for message in body_messages[:-1]] == \
+        new_notification_category_names
+    assert all(message['more_body'] for message in body_messages[:-1])
+    assert body_messages[-1] == {'type': 'http.response.body', 'body': b''}
+
+
+def test_retrieve_request_metrics(client):
+    """
+    Ensure we can retrieve the per-request phase timings and SQL statements in Prometheus format
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(
+        client,
+        'Metrics notification',
+        15,
+        'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    get_response = client.get(
+        url_for('service.notificationlistresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_response.status_code == HttpStatus.ok_200.value
+    get_metrics_response = client.get(
+        url_for('service.requestmetricsresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    assert get_metrics_response.status_code == HttpStatus.ok_200.value
+    assert get_metrics_response.mimetype == 'text/plain'
+    metrics_text = get_metrics_response.get_data(as_text=True)
+    labels = 'endpoint="service.notificationlistresource",method="GET",status="200"'
+    assert 'service_request_duration_seconds_count{' + labels + '} 1' in metrics_text
+    for phase in ['auth', 'query', 'serialize', 'encode']:
+        assert 'service_request_phase_seconds_total{' + labels + ',phase="' + phase + '"}' in metrics_text
+    assert 'service_sql_statements_total{' + labels + '} ' in metrics_text
+    assert 'service_sql_statements_total{' + labels + '} 0\n' not in metrics_text
+
+
+@pytest.mark.parametrize('file_format', ['csv', 'ndjson'])
+def test_export_and_import_notifications(application, client, tmp_path, file_format):
+    """
+    Ensure the notifications we export can be imported again with their categories
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    messages = ['Exported notification {}'.format(i) for i in range(3)]
+    for i, message in enumerate(messages):
+        post_response = create_notification(client, message, 3600, 'Category {}'.format(i % 2))
+        assert post_response.status_code == HttpStatus.created_201.value
+    runner = application.test_cli_runner()
+    export_path = str(tmp_path / 'notifications.{}'.format(file_format))
+    export_result = runner.invoke(args=[
+        'notifications', 'export', export_path, '--format', file_format])
+    assert export_result.exit_code == 0
+    assert 'Exported 3 notifications' in export_result.output
+    with open(export_path) as export_file:
+        exported_lines = export_file.read().splitlines()
+    if file_format == 'csv':
+        assert exported_lines[0] == 'message,ttl,notification_category,creation_date,displayed_times,displayed_once'
+        assert exported_lines[1].startswith('Exported notification 0,3600,Category 0,')
+        assert exported_lines[1].endswith(',0,false')
+    else:
+        exported_record = json.loads(exported_lines[0])
+        assert exported_record['message'] == 'Exported notification 0'
+        assert exported_record['notification_category'] == 'Category 0'
+        assert exported_record['displayed_once'] is False
+    exported_creation_dates = [notification.creation_date
+        for notification in Notification.query.order_by(Notification.id)]
+    Notification.query.delete()
+    NotificationCategory.query.filter_by(name='Category 1').delete()
+    orm.session.commit()
+    import_result = runner.invoke(args=[
+        'notifications', 'import', export_path, '--format', file_format])
+    assert import_result.exit_code == 0, import_result.output
+    assert 'Imported 3 notifications' in import_result.output
+    orm.session.expire_all()
+    notifications = Notification.query.order_by(Notification.id).all()
+    assert [notification.message for notification in notifications] == messages
+    assert [notification.notification_category.name for notification in notifications] == \
+        ['Category 0', 'Category 1', 'Category 0']
+    assert [notification.creation_date for notification in notifications] == exported_creation_dates
+    # The messages are unique, so importing the file again fails without importing any row
+    import_result = runner.invoke(args=[
+        'notifications', 'import', export_path, '--format', file_format])
+    assert import_result.exit_code != 0
+    assert 'The import failed and was rolled back' in import_result.output
+    assert Notification.query.count() == 3
+
+
+def test_notification_counts_and_denormalized_category_names(client, sql_statements):
+    """
+    Ensure the triggers maintain the notification counts and the category names for all the write paths
+    """
+    create_user_response = create_user(client, TEST_USER_NAME, TEST_USER_PASSWORD)
+    assert create_user_response.status_code == HttpStatus.created_201.value
+    post_response = create_notification(client, 'First notification', 3600, 'Information')
+    assert post_response.status_code == HttpStatus.created_201.value
+    post_response_data = json.loads(post_response.get_data(as_text=True))
+    assert post_response_data['notification_category']['name'] == 'Information'
+    bulk_post_response = client.post(
+        url_for('service.notificationbulkresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps([
+            {'message': 'Second notification', 'ttl': 3600, 'notification_category': 'Information'},
+            {'message': 'Third notification', 'ttl': 3600, 'notification_category': 'Warning'}]))
+    assert bulk_post_response.status_code == HttpStatus.created_201.value
+    # A bulk DELETE statement, such as the expired notifications reaper
+    Notification.query.filter_by(message='First notification').delete()
+    orm.session.commit()
+    response_cache.invalidate('notification', 'notification_category')
+    notification_category_url = post_response_data['notification_category']['url']
+    patch_response = client.patch(
+        notification_category_url,
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD),
+        data=json.dumps({'name': 'Renamed information'}))
+    assert patch_response.status_code == HttpStatus.ok_200.value
+    # The triggers modified the rows that the session already loaded
+    orm.session.expire_all()
+    get_categories_response = client.get(
+        url_for('service.notificationcategorylistresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    get_categories_response_data = json.loads(get_categories_response.get_data(as_text=True))
+    assert [(notification_category['name'], notification_category['notification_count'])
+        for notification_category in get_categories_response_data['results']] == \
+        [('Renamed information', 1), ('Warning', 1)]
+    del sql_statements[:]
+    get_response = client.get(
+        url_for('service.notificationlistresource', _external=True),
+        headers=get_authentication_headers(TEST_USER_NAME, TEST_USER_PASSWORD))
+    get_response_data = json.loads(get_response.get_data(as_text=True))
+    assert [notification['notification_category']['name'] for notification in get_response_data['results']] == \
+        ['Renamed information', 'Warning']
+    assert get_response_data['results'][0]['notification_category']['url'] == notification_category_url
+    # The notification dumps read the denormalized name without joining the categories
+    assert not any('JOIN notification_category' in statement for statement in sql_statements)
+
+
+def test_concurrent_notifications_in_the_same_category(application):
+    """
+    Ensure the count triggers don't conflict with the foreign key lock of a concurrent insert
+    """
+    notification_category = NotificationCategory('Information')
+    orm.session.add(notification_category)
+    orm.session.commit()
+    notification_category_id = notification_category.id
+    notification_table = Notification.__table__
+    first_connection = orm.engine.connect()
+    second_connection = orm.engine.connect()
+    try:
+        first_transaction = first_connection.begin()
+        # The same lock that the foreign key check takes for an insert that didn't commit yet
+        first_connection.execute(
+            'SELECT 1 FROM notification_category WHERE id = %s FOR KEY SHARE', notification_category_id)
+        second_transaction = second_connection.begin()
+        # Fails instead of waiting when the trigger lock conflicts with the first transaction
+        second_connection.execute("SET LOCAL lock_timeout = '2s'")
+        second_connection.execute(notification_table.insert().values(
+            message='Second notification', ttl=3600, notification_category_id=notification_category_id))
+        second_transaction.commit()
+        first_connection.execute(notification_table.insert().values(
+            message='First notification', ttl=3600, notification_category_id=notification_category_id))
+        first_transaction.commit()
+    finally:
+        first_connection.close()
+        second_connection.close()
+    orm.session.expire_all()
+    assert NotificationCategory.query.get(notification_category_id).notification_count == 2
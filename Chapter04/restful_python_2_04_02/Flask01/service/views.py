@@ -1,22 +1,62 @@
-from flask import Blueprint, request, jsonify, make_response
+from flask import Blueprint, request, jsonify, make_response, Response
 from flask_restful import Api, Resource
 from http_status import HttpStatus
 from models import orm, NotificationCategory, NotificationCategorySchema, Notification, NotificationSchema
-from sqlalchemy.exc import SQLAlchemyError
-from helpers import PaginationHelper
-from flask_httpauth import HTTPBasicAuth
-from flask import g
+from models import is_unique_violation, display_counter_buffer
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from helpers import PaginationHelper, verified_credentials_cache
+from helpers import get_etag, make_not_modified_response, encode_json
+from helpers import parse_boolean, parse_datetime, parse_seconds, SparseFieldsets
+from response_cache import response_cache
+from serializers import CompiledSerializer
+from pool_metrics import pool_metrics
+from request_metrics import request_metrics
+from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth, MultiAuth
+from flask import g, current_app
+from itsdangerous import TimedJSONWebSignatureSerializer, BadSignature, SignatureExpired
 from models import User, UserSchema
 
 
-auth = HTTPBasicAuth()
+basic_auth = HTTPBasicAuth()
+token_auth = HTTPTokenAuth(scheme='Bearer')
+# Requests with a Bearer token use token_auth, the other requests use basic_auth
+auth = MultiAuth(basic_auth, token_auth)
 
 
-@auth.verify_password
+@basic_auth.verify_password
+@request_metrics.timed('auth')
 def verify_user_password(name, password):
+    # Avoid the query and the slow password hash verification
+    # for credentials that were already verified
+    cached_values = verified_credentials_cache.get(name, password)
+    if cached_values is not None:
+        g.user = User.from_cache_values(cached_values)
+        return True
     user = User.query.filter_by(name=name).first()
     if not user or not user.verify_password(password):
         return False
+    verified_credentials_cache.set(name, password, user.get_cache_values())
+    g.user = user
+    return True
+
+
+def get_token_serializer():
+    return TimedJSONWebSignatureSerializer(
+        current_app.config['SECRET_KEY'],
+        expires_in=current_app.config['AUTH_TOKEN_EXPIRATION'])
+
+
+@token_auth.verify_token
+@request_metrics.timed('auth')
+def verify_user_token(token):
+    try:
+        token_data = get_token_serializer().loads(token)
+    except (BadSignature, SignatureExpired):
+        return False
+    user = User.query.get(token_data['id'])
+    if not user:
+        return False
     g.user = user
     return True
 
@@ -29,25 +69,88 @@ user_schema = UserSchema()
 service_blueprint = Blueprint('service', __name__)
 notification_category_schema = NotificationCategorySchema()
 notification_schema = NotificationSchema()
+notification_partial_schema = NotificationSchema(partial=True)
+# The compiled serializers produce the same output as the schemas with less overhead
+user_serializer = CompiledSerializer(user_schema)
+notification_category_serializer = CompiledSerializer(notification_category_schema)
+notification_serializer = CompiledSerializer(notification_schema)
+# The notification resources serialize and load only the fields requested with ?fields=
+notification_fieldsets = SparseFieldsets(
+    NotificationSchema,
+    Notification,
+    required_columns=(Notification.id, Notification.version),
+    # The nested category reads the denormalized name instead of joining the category
+    field_columns={
+        'notification_category': (
+            Notification.notification_category_id, Notification.notification_category_name)})
+# The filters for the notifications list translate each query argument to
+# a predicate that the notification indexes support
+notification_filters = {
+    'notification_category': lambda value: Notification.notification_category_id == orm.select(
+        [NotificationCategory.id]).where(NotificationCategory.name == value).as_scalar(),
+    'displayed_once': lambda value: Notification.displayed_once == parse_boolean(value),
+    'creation_date_from': lambda value: Notification.creation_date >= parse_datetime(value),
+    'creation_date_to': lambda value: Notification.creation_date < parse_datetime(value),
+    'ttl_remaining_min': lambda value: Notification.expiration_date >=
+        orm.func.localtimestamp() + parse_seconds(value),
+}
+notification_orderings = {
+    'creation_date': (Notification.creation_date, Notification.id),
+    'id': (Notification.id,),
+    'message': (Notification.message,),
+}
 service = Api(service_blueprint)
 
 
+@service.representation('application/json')
+def output_json(data, code, headers=None):
+    response = make_response(encode_json(data), code)
+    response.headers.extend(headers or {})
+    return response
+
+
 class UserResource(AuthenticationRequiredResource):
     def get(self, id):
         user = User.query.get_or_404(id)
-        result = user_schema.dump(user).data
+        result = user_serializer.dump(user).data
         return result
 
 
+class TokenResource(AuthenticationRequiredResource):
+    def get(self):
+        token = get_token_serializer().dumps({'id': g.user.id}).decode('ascii')
+        return {'token': token, 'expiration': current_app.config['AUTH_TOKEN_EXPIRATION']}
+
+
+class ResponseCacheResource(AuthenticationRequiredResource):
+    def get(self):
+        return response_cache.get_stats()
+
+
+class PoolMetricsResource(AuthenticationRequiredResource):
+    def get(self):
+        return pool_metrics.get_stats()
+
+
+class RequestMetricsResource(AuthenticationRequiredResource):
+    def get(self):
+        # Prometheus text exposition format
+        return Response(
+            request_metrics.get_prometheus_text(),
+            mimetype='text/plain; version=0.0.4')
+
+
 class UserListResource(Resource):
     @auth.login_required
+    @response_cache.cached('user')
     def get(self):
         pagination_helper = PaginationHelper(
             request,
             query=User.query,
             resource_for_url='service.userlistresource',
             key_name='results',
-            schema=user_schema)
+            schema=user_serializer,
+            keyset_columns=(User.name, User.id))
         result = pagination_helper.paginate_query()
         return result
 
@@ -69,9 +172,8 @@ class UserListResource(Resource):
             error_message, password_ok = \
                 user.check_password_strength_and_hash_if_ok(user_dict['password'])
             if password_ok:
-                user.add(user)
-                query = User.query.get(user.id)
-                dump_result = user_schema.dump(query).data
+                user = user.add(user)
+                dump_result = user_serializer.dump(user).data
                 return dump_result, HttpStatus.created_201.value
             else:
                 return {"error": error_message}, HttpStatus.bad_request_400.value
@@ -83,42 +185,63 @@ class UserListResource(Resource):
 
 class NotificationResource(AuthenticationRequiredResource):
     def get(self, id):
-        notification = Notification.query.get_or_404(id)
-        dumped_notification = notification_schema.dump(notification).data
-        return dumped_notification
+        try:
+            field_names = notification_fieldsets.parse_fields(request)
+        except ValueError as e:
+            response = {'error': str(e)}
+            return response, HttpStatus.bad_request_400.value
+        # Expired notifications are no longer available, even before the reaper deletes them
+        notification = Notification.get_unexpired_query().options(
+            *notification_fieldsets.get_query_options(field_names)).filter(
+            Notification.id == id).first_or_404()
+        etag_values = ['notification', notification.id, notification.version]
+        if field_names is None or 'notification_category' in field_names:
+            # The representation includes the notification category. The triggers
+            # update the denormalized name when the category is renamed
+            etag_values.extend([
+                notification.notification_category_id, notification.notification_category_name])
+        if field_names is not None:
+            etag_values.extend(sorted(field_names))
+        etag = get_etag(*etag_values)
+        if etag in request.if_none_match:
+            return make_not_modified_response(etag)
+        dumped_notification = notification_fieldsets.get_serializer(field_names).dump(notification).data
+        return dumped_notification, HttpStatus.ok_200.value, {'ETag': '"{}"'.format(etag)}
 
     def patch(self, id):
-        notification = Notification.query.get_or_404(id)
         notification_dict = request.get_json(force=True)
-        print(notification_dict)
-        if 'message' in notification_dict and notification_dict['message'] is not None:
-            notification_message = notification_dict['message']
-            if not Notification.is_message_unique(id=0, message=notification_message):
-                response = {'error': 'A notification with the message {} already exists'.format(notification_message)}
-                return response, HttpStatus.bad_request_400.value
-            notification.message = notification_message
-        if 'ttl' in notification_dict and notification_dict['ttl'] is not None:
-            notification.duration = notification_dict['duration']
-        if 'displayed_times' in notification_dict and notification_dict['displayed_times'] is not None:
-            notification.displayed_times = notification_dict['displayed_times']
-        if 'displayed_once' in notification_dict and notification_dict['displayed_once'] is not None:
-            notification.displayed_once = notification_dict['displayed_once'] == 'true'
-        dumped_notification, dump_errors = notification_schema.dump(notification)
-        if dump_errors:
-            return dump_errors, HttpStatus.bad_request_400.value
-        validate_errors = notification_schema.validate(dumped_notification)
-        if validate_errors:
-            return validate_errors, HttpStatus.bad_request_400.value
+        if not notification_dict:
+            response = {'message': 'No input data provided'}
+            return response, HttpStatus.bad_request_400.value
+        # Validate and deserialize only the supplied fields
+        notification_data, errors = notification_partial_schema.load(notification_dict)
+        if errors:
+            return errors, HttpStatus.bad_request_400.value
+        notification = Notification.get_unexpired_query().filter(
+            Notification.id == id).first_or_404()
+        for field_name in ('message', 'ttl', 'displayed_times', 'displayed_once'):
+            if notification_data.get(field_name) is not None:
+                setattr(notification, field_name, notification_data[field_name])
         try:
-            notification.update()
-            return self.get(id)
+            # The UPDATE statement only includes the changed columns
+            notification = notification.update()
+            dumped_notification = notification_serializer.dump(notification).data
+            return dumped_notification
+        except IntegrityError as e:
+            orm.session.rollback()
+            if is_unique_violation(e):
+                response = {'error': 'A notification with the message {} already exists'.format(notification_data['message'])}
+            else:
+                response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
         except SQLAlchemyError as e:
                 orm.session.rollback()
                 response = {"error": str(e)}
                 return response, HttpStatus.bad_request_400.value
          
     def delete(self, id):
-        notification = Notification.query.get_or_404(id)
+        notification = Notification.get_unexpired_query().filter(
+            Notification.id == id).first_or_404()
         try:
             delete = notification.delete(notification)
             response = make_response()
@@ -129,14 +252,55 @@ class NotificationResource(AuthenticationRequiredResource):
                 return response, HttpStatus.unauthorized_401.value
 
 
+class NotificationDisplayResource(AuthenticationRequiredResource):
+    def post(self, id):
+        display_dict = request.get_json(silent=True) or {}
+        times = display_dict.get('times', 1)
+        max_times = current_app.config['DISPLAY_COUNTER_MAX_TIMES']
+        if not isinstance(times, int) or isinstance(times, bool) or times < 1:
+            response = {'times': 'The number of times must be a positive integer'}
+            return response, HttpStatus.bad_request_400.value
+        if times > max_times:
+            response = {'times': 'The number of times cannot be greater than {}'.format(max_times)}
+            return response, HttpStatus.bad_request_400.value
+        if current_app.config['DISPLAY_COUNTER_BUFFER_ENABLED']:
+            # The buffer coalesces the increments and applies them periodically
+            display_counter_buffer.add(id, times)
+            return {'id': id, 'times': times}, HttpStatus.accepted_202.value
+        try:
+            row = Notification.increment_displayed_times(id, times)
+        except SQLAlchemyError as e:
+            orm.session.rollback()
+            response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
+        if row is None:
+            response = {'error': 'The notification {} does not exist'.format(id)}
+            return response, HttpStatus.not_found_404.value
+        return {
+            'id': id,
+            'displayed_times': row.displayed_times,
+            'displayed_once': row.displayed_once
+        }
+
+
 class NotificationListResource(AuthenticationRequiredResource):
+    @response_cache.cached('notification', 'notification_category')
     def get(self):
+        try:
+            field_names = notification_fieldsets.parse_fields(request)
+        except ValueError as e:
+            response = {'error': str(e)}
+            return response, HttpStatus.bad_request_400.value
         pagination_helper = PaginationHelper(
             request,
-            query=Notification.query,
+            query=Notification.get_unexpired_query().options(
+                *notification_fieldsets.get_query_options(field_names)),
             resource_for_url='service.notificationlistresource',
             key_name='results',
-            schema=notification_schema)
+            schema=notification_fieldsets.get_serializer(field_names),
+            keyset_columns=notification_orderings['creation_date'],
+            filters=notification_filters,
+            orderings=notification_orderings)
         pagination_result = pagination_helper.paginate_query()
         return pagination_result
 
@@ -149,26 +313,98 @@ class NotificationListResource(AuthenticationRequiredResource):
         if errors:
             return errors, HttpStatus.bad_request_400.value
         notification_message = notification_category_dict['message']
-        if not Notification.is_message_unique(id=0, message=notification_message):
-            response = {'error': 'A notification with the message {} already exists'.format(notification_message)}
-            return response, HttpStatus.bad_request_400.value
         try:
             notification_category_name = notification_category_dict['notification_category']['name']
-            notification_category = NotificationCategory.query.filter_by(name=notification_category_name).first()
-            if notification_category is None:
-                # Create a new NotificationCategory
-                notification_category = NotificationCategory(name=notification_category_name)
-                orm.session.add(notification_category)
+            # Retrieve the notification category or create a new one
+            notification_category = NotificationCategory.get_or_create(notification_category_name)
             # Now that we are sure we have a notification category,
             # we can create a new Notification
             notification = Notification(
                 message=notification_message,
                 ttl=notification_category_dict['ttl'],
                 notification_category=notification_category)
-            notification.add(notification)
-            query = Notification.query.get(notification.id)
-            dump_result = notification_schema.dump(query).data
+            notification = notification.add(notification)
+            dump_result = notification_serializer.dump(notification).data
             return dump_result, HttpStatus.created_201.value
+        except IntegrityError as e:
+            orm.session.rollback()
+            # The unique constraint rejects duplicated messages
+            if is_unique_violation(e):
+                response = {'error': 'A notification with the message {} already exists'.format(notification_message)}
+            else:
+                response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
+        except SQLAlchemyError as e:
+            orm.session.rollback()
+            response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
+
+
+class NotificationBulkResource(AuthenticationRequiredResource):
+    def post(self):
+        notification_dicts = request.get_json()
+        if not notification_dicts:
+            response = {'message': 'No input data provided'}
+            return response, HttpStatus.bad_request_400.value
+        if not isinstance(notification_dicts, list) or \
+                not all(isinstance(notification_dict, dict) for notification_dict in notification_dicts):
+            response = {'message': 'The input data must be a list of notifications'}
+            return response, HttpStatus.bad_request_400.value
+        max_size = current_app.config['BULK_CREATE_MAX_SIZE']
+        if len(notification_dicts) > max_size:
+            response = {'message': 'The input data cannot include more than {} notifications'.format(max_size)}
+            return response, HttpStatus.bad_request_400.value
+        errors = notification_schema.validate(notification_dicts, many=True)
+        for index, notification_dict in enumerate(notification_dicts):
+            if index not in errors and notification_dict.get('ttl') is None:
+                errors[index] = {'ttl': ['Missing data for required field.']}
+        valid_notification_dicts = [(index, notification_dict)
+            for index, notification_dict in enumerate(notification_dicts)
+            if index not in errors]
+        notification_dicts_to_insert = []
+        notification_indexes = {}
+        for index, notification_dict in valid_notification_dicts:
+            notification_message = notification_dict['message']
+            if notification_message in notification_indexes:
+                # Duplicated messages in the same request are also rejected
+                errors[index] = {'error': 'A notification with the message {} already exists'.format(notification_message)}
+            else:
+                notification_indexes[notification_message] = index
+                notification_dicts_to_insert.append(notification_dict)
+        if not notification_dicts_to_insert:
+            return {'results': [], 'errors': errors}, HttpStatus.bad_request_400.value
+        try:
+            # Retrieve or create all the categories with a single query and a single insert
+            notification_category_ids = NotificationCategory.get_or_create_ids(
+                notification_dict['notification_category']['name']
+                for notification_dict in notification_dicts_to_insert)
+            # ON CONFLICT DO NOTHING skips the existing messages, including the ones
+            # that concurrent requests insert, instead of failing the whole batch
+            notification_table = Notification.__table__
+            inserted_notifications = orm.session.execute(
+                postgresql_insert(notification_table).values([{
+                    'message': notification_dict['message'],
+                    'ttl': notification_dict['ttl'],
+                    'notification_category_id':
+                        notification_category_ids[notification_dict['notification_category']['name']]}
+                    for notification_dict in notification_dicts_to_insert]).on_conflict_do_nothing(
+                    index_elements=['message']).returning(
+                    notification_table.c.id, notification_table.c.message))
+            inserted_messages = {message: id for id, message in inserted_notifications.fetchall()}
+            for notification_message, index in notification_indexes.items():
+                if notification_message not in inserted_messages:
+                    errors[index] = {'error': 'A notification with the message {} already exists'.format(notification_message)}
+            if not inserted_messages:
+                orm.session.rollback()
+                return {'results': [], 'errors': errors}, HttpStatus.bad_request_400.value
+            notification_ids = list(inserted_messages.values())
+            orm.session.commit()
+            Notification.notify_after_commit('add', Notification.__tablename__)
+            Notification.notify_after_commit('add', NotificationCategory.__tablename__)
+            notifications = Notification.query.filter(
+                Notification.id.in_(notification_ids)).order_by(Notification.id).all()
+            dump_results = notification_serializer.dump(notifications, many=True).data
+            return {'results': dump_results, 'errors': errors}, HttpStatus.created_201.value
         except SQLAlchemyError as e:
             orm.session.rollback()
             response = {"error": str(e)}
@@ -178,8 +414,15 @@ class NotificationListResource(AuthenticationRequiredResource):
 class NotificationCategoryResource(AuthenticationRequiredResource):
     def get(self, id):
         notification_category = NotificationCategory.query.get_or_404(id)
-        dump_result = notification_category_schema.dump(notification_category).data
-        return dump_result
+        # The representation includes the unexpired notifications and the stored notifications count
+        etag = get_etag(
+            'notification_category', notification_category.id, notification_category.version,
+            notification_category.notification_count,
+            notification_category.get_notifications_digest())
+        if etag in request.if_none_match:
+            return make_not_modified_response(etag)
+        dump_result = notification_category_serializer.dump(notification_category).data
+        return dump_result, HttpStatus.ok_200.value, {'ETag': '"{}"'.format(etag)}
 
     def patch(self, id):
         notification_category = NotificationCategory.query.get_or_404(id)
@@ -192,14 +435,17 @@ class NotificationCategoryResource(AuthenticationRequiredResource):
             return errors, HttpStatus.bad_request_400.value
         try:
             if 'name' in notification_category_dict and notification_category_dict['name'] is not None:
-                notification_category_name = notification_category_dict['name']
-                if NotificationCategory.is_name_unique(id=id, name=notification_category_name):
-                    notification_category.name = notification_category_name
-                else:
-                    response = {'error': 'A category with the name {} already exists'.format(notification_category_name)}
-                    return response, HttpStatus.bad_request_400.value
-            notification_category.update()
-            return self.get(id)
+                notification_category.name = notification_category_dict['name']
+            notification_category = notification_category.update()
+            dump_result = notification_category_serializer.dump(notification_category).data
+            return dump_result
+        except IntegrityError as e:
+            orm.session.rollback()
+            if is_unique_violation(e):
+                response = {'error': 'A category with the name {} already exists'.format(notification_category_dict['name'])}
+            else:
+                response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
         except SQLAlchemyError as e:
                 orm.session.rollback()
                 response = {"error": str(e)}
@@ -218,10 +464,21 @@ class NotificationCategoryResource(AuthenticationRequiredResource):
 
 
 class NotificationCategoryListResource(AuthenticationRequiredResource):
+    @response_cache.cached('notification_category', 'notification')
     def get(self):
-        notification_categories = NotificationCategory.query.all()
-        dump_results = notification_category_schema.dump(notification_categories, many=True).data
-        return dump_results
+        pagination_helper = PaginationHelper(
+            request,
+            # Load the notifications for all the categories with a single additional query
+            query=NotificationCategory.query.options(
+                orm.selectinload(NotificationCategory.notifications)),
+            resource_for_url='service.notificationcategorylistresource',
+            key_name='results',
+            schema=notification_category_serializer,
+            keyset_columns=(NotificationCategory.id,))
+        if pagination_helper.is_stream_requested():
+            return pagination_helper.stream_query()
+        pagination_result = pagination_helper.paginate_query()
+        return pagination_result
 
     def post(self):
         print("Processing")
@@ -233,15 +490,19 @@ class NotificationCategoryListResource(AuthenticationRequiredResource):
         if errors:
             return errors, HttpStatus.bad_request_400.value
         notification_category_name = notification_category_dict['name']
-        if not NotificationCategory.is_name_unique(id=0, name=notification_category_name):
-            response = {'error': 'A notification category with the name {} already exists'.format(notification_category_name)}
-            return response, HttpStatus.bad_request_400.value
         try:
             notification_category = NotificationCategory(notification_category_name)
-            notification_category.add(notification_category)
-            query = NotificationCategory.query.get(notification_category.id)
-            dump_result = notification_category_schema.dump(query).data
+            notification_category = notification_category.add(notification_category)
+            dump_result = notification_category_serializer.dump(notification_category).data
             return dump_result, HttpStatus.created_201.value
+        except IntegrityError as e:
+            orm.session.rollback()
+            # The unique constraint rejects duplicated names
+            if is_unique_violation(e):
+                response = {'error': 'A notification category with the name {} already exists'.format(notification_category_name)}
+            else:
+                response = {"error": str(e)}
+            return response, HttpStatus.bad_request_400.value
         except SQLAlchemyError as e:
             print("Error")
             print(e)
@@ -258,8 +519,20 @@ service.add_resource(NotificationListResource,
     '/notifications/')
 service.add_resource(NotificationResource, 
     '/notifications/<int:id>')
+service.add_resource(NotificationDisplayResource, 
+    '/notifications/<int:id>/displays')
+service.add_resource(NotificationBulkResource, 
+    '/notifications/bulk/')
 service.add_resource(UserListResource, 
     '/users/')
 service.add_resource(UserResource, 
     '/users/<int:id>')
+service.add_resource(TokenResource, 
+    '/token')
+service.add_resource(ResponseCacheResource, 
+    '/_response_cache')
+service.add_resource(PoolMetricsResource, 
+    '/_pool')
+service.add_resource(RequestMetricsResource, 
+    '/_metrics')
 